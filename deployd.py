@@ -1,7 +1,13 @@
 #!/usr/bin/env python
+import json
 import logging
+import os
+import shutil
 import socket
+import StringIO
+import tempfile
 import threading
+import time
 import urllib2
 
 from pypxe import tftp
@@ -11,37 +17,169 @@ from dnslib import A
 
 
 DEPLOY_URL = 'https://deploy.tech.dreamhack.se/tftp/{filename}'
+CACHE_DIRECTORY = '/var/cache/deployd'
+# UEFI clients (option 93 arch 7 and 9) chainload the EFI build of iPXE,
+# BIOS clients undionly.kpxe from DHCPD.filename
+BOOT_RULES = [{'arch': [7, 9], 'filename': 'ipxe.efi'}]
 
 
-class HttpBackedClient(tftp.AbstractClient):
-  def __init__(self, *args):
-    super(HttpBackedClient, self).__init__(*args)
-    self.fh = None
+class UpstreamCache(object):
+  """Pull-through disk cache of the files on DEPLOY_URL.
 
-  def check_file(self, filename):
-    url = DEPLOY_URL.format(filename=filename)
+  Files are fetched once and then served from disk. A copy older than
+  revalidate_after seconds is revalidated with a conditional GET, and
+  concurrent misses for the same file wait for a single upstream fetch.
+  Copies are kept under files/ and their validators under meta/, so
+  any upstream name can be cached.
+  """
+
+  def __init__(self, directory, url=DEPLOY_URL, revalidate_after=30, timeout=2):
+    self.directory = directory
+    self.url = url
+    self.revalidate_after = revalidate_after
+    self.timeout = timeout
+    self.lock = threading.Lock()
+    # key is filename, value is the lock held while fetching or
+    # revalidating it and the number of requests using it
+    self.locks = {}
+    # key is filename, value is the validators and time of last check
+    self.meta = {}
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def path(self, filename, tree='files'):
+    parts = [p for p in filename.split('/') if p not in ('', '.')]
+    if not parts or '..' in parts:
+      return None
+    return os.path.join(self.directory, tree, *parts)
+
+  def fetch(self, filename):
+    """Returns the local path of an up to date copy, or None."""
+    path = self.path(filename)
+    if path is None:
+      return None
+    with self.lock:
+      entry = self.locks.setdefault(filename, [threading.Lock(), 0])
+      entry[1] += 1
+    try:
+      with entry[0]:
+        meta = self.meta.get(filename)
+        if meta is None:
+          meta = self.read_meta(filename)
+          if meta:
+            self.meta[filename] = meta
+        if meta and not os.path.exists(path):
+          meta = None
+        if meta and time.time() - meta['checked'] < self.revalidate_after:
+          return path
+        return self.download(filename, path, meta)
+    finally:
+      with self.lock:
+        entry[1] -= 1
+        if not entry[1]:
+          del self.locks[filename]
+
+  def read_meta(self, filename):
+    """Returns the stored validators of filename, or None."""
+    try:
+      with open(self.path(filename, 'meta')) as f:
+        meta = json.load(f)
+      meta['checked'] = float(meta['checked'])
+      return meta
+    except (IOError, OSError, ValueError, TypeError, KeyError):
+      return None
+
+  def write(self, path, source, length=None):
+    """Atomically replaces path with the file-like source, if length bytes long."""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    fd, temp = tempfile.mkstemp(dir=directory)
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        shutil.copyfileobj(source, f)
+      if length is not None and os.path.getsize(temp) != length:
+        raise IOError('short read of {0}'.format(path))
+      os.rename(temp, path)
+    except (IOError, OSError, socket.error):
+      os.remove(temp)
+      raise
+
+  def forget(self, filename, path):
+    """Drops the cached copy of a file that is gone upstream."""
+    self.meta.pop(filename, None)
+    for stale in (path, self.path(filename, 'meta')):
+      if os.path.exists(stale):
+        os.remove(stale)
+
+  def download(self, filename, path, meta):
+    url = self.url.format(filename=filename)
     request = urllib2.Request(url)
-    request.get_method = lambda: 'HEAD'
+    if meta and meta.get('etag'):
+      request.add_header('If-None-Match', meta['etag'])
+    if meta and meta.get('last_modified'):
+      request.add_header('If-Modified-Since', meta['last_modified'])
     try:
-      response = urllib2.urlopen(request, timeout=2)
-    except urllib2.URLError:
+      response = urllib2.urlopen(request, timeout=self.timeout)
+    except urllib2.HTTPError as e:
+      if e.code == 304 and meta:
+        meta['checked'] = time.time()
+        return path
+      if e.code == 404:
+        logging.warning('Unable to fetch %s: %s', url, e)
+        self.forget(filename, path)
+        return None
+      if meta:
+        logging.warning('Unable to revalidate %s: %s, serving cached copy', url, e)
+        return path
+      logging.warning('Unable to fetch %s: %s', url, e)
+      return None
+    except (urllib2.URLError, socket.error):
+      if meta:
+        logging.warning('Unable to revalidate %s, serving cached copy', url)
+        return path
       logging.exception('Unable to access %s', url)
-      return False
-    return True
-
-  def next_block(self):
-    if self.fh is None:
       return None
-    return self.fh.read(self.blksize)
 
-  def prepare_request(self, filename):
-    url = DEPLOY_URL.format(filename=filename)
-    self.fh = urllib2.urlopen(url, timeout=2)
-    self.filesize = 0
+    try:
+      length = response.info().getheader('Content-Length')
+      self.write(path, response, int(length) if length is not None else None)
+    except (IOError, OSError, socket.error):
+      logging.exception('Unable to fetch %s', url)
+      return path if meta else None
+    finally:
+      response.close()
+    meta = {
+        'etag': response.info().getheader('ETag'),
+        'last_modified': response.info().getheader('Last-Modified'),
+        'checked': time.time()}
+    self.meta[filename] = meta
+    try:
+      self.write(self.path(filename, 'meta'), StringIO.StringIO(json.dumps(meta)))
+    except (IOError, OSError):
+      logging.exception('Unable to store the validators of %s', url)
+    return path
+
+
+class HttpBackedClient(tftp.FileBackedClient):
+  # fetching from upstream may take a while, blocks come from local disk
+  blocking_open = True
+
+  def __init__(self, *args):
+    super(HttpBackedClient, self).__init__(*args)
+    self.path = None
+
+  def check_file(self, filename):
+    self.path = self.parent.upstream.fetch(filename)
+    return self.path is not None
+
+  def local_path(self, filename):
+    return self.path
 
 
 class TFTPD(tftp.BaseTFTPD):
   def __init__(self, **kwargs):
+    self.upstream = UpstreamCache(kwargs.pop('cache_directory', CACHE_DIRECTORY))
     super(TFTPD, self).__init__(HttpBackedClient, **kwargs)
 
 
@@ -95,6 +233,7 @@ if __name__ == '__main__':
       dns_server='10.32.12.1',
       broadcast='10.32.12.255',
       file_server='10.32.12.1',
+      static_config={'dhcp': {'boot': BOOT_RULES}},
       logger=dhcp_logger)
 
   dhcpd = threading.Thread(target = dhcp_server.listen)
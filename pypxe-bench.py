@@ -0,0 +1,532 @@
+#!/usr/bin/env python
+'''
+
+Benchmarks for the PyPXE services, run with --help for the available
+benchmarks and their options
+
+'''
+import os
+import sys
+import time
+import errno
+import random
+import select
+import signal
+import socket
+import struct
+import shutil
+import hashlib
+import logging
+import resource
+import tempfile
+
+try:
+    import argparse
+except ImportError:
+    sys.exit("ImportError: You do not have the Python 'argparse' module installed. Please install the 'argparse' module and try again.")
+
+from pypxe import tftp # PyPXE TFTP service
+from pypxe import dhcp # PyPXE DHCP service
+
+def parse_size(size):
+    '''Converts a size like 512, 64K or 300M to bytes.'''
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    size = size.strip().upper()
+    if size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def wire_block(block, rollover):
+    '''Returns the 16 bit block number of an (absolute) block number.'''
+    if rollover and block > 0:
+        return (block - 1) % 65535 + 1
+    return block % 65536
+
+def percentile(values, fraction):
+    '''Returns the value below which the given fraction of values fall.'''
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class BenchClient(object):
+    '''A simulated PXE client fetching one file over TFTP.'''
+
+    def __init__(self, filename, args):
+        self.filename = filename
+        self.args = args
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.setblocking(0)
+        # room for a few windows of large blocks, or most of them are dropped
+        rcvbuf = 4 * max(args.windowsize, 1) * (args.blksize + 4)
+        if rcvbuf > self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF):
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.server = None # the server's transfer ID, once known
+        self.blksize = 512
+        self.window = 1
+        self.rollover = args.rollover
+        self.expect = 1 # next block we need
+        self.acked = 0 # last block we acknowledged
+        self.gap_acked = False
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self.duplicates = 0
+        self.retries = 0
+        self.done = False
+        self.failed = False
+        self.started = self.finished = self.last_rx = None
+
+    def send(self, packet, address):
+        '''Sends a packet unless the simulated network drops it.'''
+        if self.args.loss and random.random() < self.args.loss:
+            return
+        self.sock.sendto(packet, address)
+
+    def start(self):
+        request = struct.pack('!H', 1) + self.filename + chr(0) + 'octet' + chr(0)
+        request += 'tsize' + chr(0) + '0' + chr(0)
+        request += 'blksize' + chr(0) + str(self.args.blksize) + chr(0)
+        if self.args.windowsize > 1:
+            request += 'windowsize' + chr(0) + str(self.args.windowsize) + chr(0)
+        self.request = request
+        self.started = self.last_rx = time.time()
+        self.send(self.request, ('127.0.0.1', self.args.port))
+
+    def ack(self, block):
+        self.acked = block
+        self.gap_acked = False
+        self.send(struct.pack('!HH', 4, wire_block(block, self.rollover)), self.server)
+
+    def ready(self):
+        '''Reads every packet waiting on our socket.'''
+        while not self.done:
+            try:
+                packet, address = self.sock.recvfrom(65536)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            if self.args.loss and random.random() < self.args.loss:
+                continue
+            self.last_rx = time.time()
+            self.retries = 0
+            self.handle(packet, address)
+
+    def handle(self, packet, address):
+        [opcode] = struct.unpack('!H', packet[:2])
+        if opcode == 6: # OACK
+            if self.server is None:
+                self.server = address
+                options = packet[2:].split(chr(0))[:-1]
+                options = dict(zip(options[0::2], options[1::2]))
+                self.blksize = int(options.get('blksize', 512))
+                self.window = int(options.get('windowsize', 1))
+                self.rollover = int(options.get('rollover', self.rollover))
+            if self.expect == 1:
+                self.ack(0)
+        elif opcode == 3: # DATA
+            self.server = self.server or address
+            [block] = struct.unpack('!H', packet[2:4])
+            if block != wire_block(self.expect, self.rollover):
+                self.duplicates += 1
+                if not self.gap_acked:
+                    # tell the server where to restart, once per window
+                    self.gap_acked = True
+                    self.send(struct.pack('!HH', 4, wire_block(self.expect - 1, self.rollover)), self.server)
+                return
+            data = packet[4:]
+            self.md5.update(data)
+            self.size += len(data)
+            last = len(data) < self.blksize
+            self.expect += 1
+            if last or self.expect - 1 - self.acked >= self.window:
+                self.ack(self.expect - 1)
+            if last:
+                self.done = True
+                self.finished = time.time()
+        elif opcode == 5: # ERROR
+            self.done = self.failed = True
+            self.finished = time.time()
+
+    def tick(self, now):
+        '''Re-requests or re-acknowledges after a client side timeout.'''
+        if self.done or now - self.last_rx < self.args.client_timeout:
+            return
+        self.retries += 1
+        if self.retries > 5:
+            self.done = self.failed = True
+            self.finished = now
+            return
+        self.last_rx = now
+        if self.server is None:
+            self.send(self.request, ('127.0.0.1', self.args.port))
+        else:
+            self.send(struct.pack('!HH', 4, wire_block(self.expect - 1, self.rollover)), self.server)
+
+def read_stats(port):
+    '''Returns the counters served on the TFTP stats port.'''
+    conn = socket.create_connection(('127.0.0.1', port), 5)
+    text = ''
+    while True:
+        data = conn.recv(65536)
+        if not data:
+            break
+        text += data
+    conn.close()
+    stats = {}
+    for line in text.splitlines():
+        name, value = line.rsplit(' ', 1)
+        stats[name] = float(value)
+    return stats
+
+def start_tftp_server(directory, args):
+    '''Forks a TFTP server serving directory, returns its pid.'''
+    pid = os.fork()
+    if pid:
+        # wait for the server to come up
+        for _ in xrange(100):
+            try:
+                read_stats(args.port + 1)
+                return pid
+            except socket.error:
+                time.sleep(0.05)
+        sys.exit('TFTP server did not start')
+    try:
+        os.chdir(directory)
+        logger = logging.getLogger('TFTP')
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+        server = tftp.BaseTFTPD(
+            tftp.FileBackedClient,
+            ip = '127.0.0.1',
+            port = args.port,
+            timeout = args.timeout,
+            max_window = max(args.windowsize, 1),
+            block_rollover = args.rollover,
+            rate_limit = parse_size(args.rate_limit) if args.rate_limit else None,
+            client_rate_limit = parse_size(args.client_rate_limit) if args.client_rate_limit else None,
+            cache_size = parse_size(args.cache_size),
+            stats_port = args.port + 1,
+            logger = logger)
+        server.listen()
+    finally:
+        os._exit(0)
+
+def run_tftp_level(clients, files, args):
+    '''Runs one round of concurrent clients, returns the finished clients.'''
+    poller = select.epoll()
+    pending = {}
+    names = sorted(files)
+    for i in xrange(clients):
+        client = BenchClient(names[i % len(names)], args)
+        pending[client.sock.fileno()] = client
+        poller.register(client.sock.fileno(), select.EPOLLIN)
+    ramp = args.ramp / float(clients)
+    unstarted = list(pending.values())
+    finished = []
+    next_start = time.time()
+    while pending:
+        now = time.time()
+        while unstarted and now >= next_start:
+            unstarted.pop().start()
+            next_start += ramp
+        for fd, _ in poller.poll(0.05):
+            client = pending.get(fd)
+            if client:
+                client.ready()
+        now = time.time()
+        for fd, client in pending.items():
+            if client.started:
+                client.tick(now)
+            if client.done:
+                poller.unregister(fd)
+                client.sock.close()
+                finished.append(pending.pop(fd))
+    poller.close()
+    return finished
+
+def bench_tftp(args):
+    directory = tempfile.mkdtemp(prefix = 'pypxe-bench-')
+    try:
+        files = {}
+        for size in args.sizes.split(','):
+            name = 'file-{0}'.format(size.strip())
+            with open(os.path.join(directory, name), 'wb') as f:
+                md5 = hashlib.md5()
+                remaining = parse_size(size)
+                while remaining:
+                    chunk = os.urandom(min(remaining, 1024 * 1024))
+                    md5.update(chunk)
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            files[name] = (parse_size(size), md5.hexdigest())
+
+        print '{0:>7} {1:>6} {2:>10} {3:>8} {4:>8} {5:>8} {6:>8} {7:>9} {8:>8} {9:>7}'.format(
+            'clients', 'failed', 'MiB/s', 'p50 s', 'p90 s', 'p99 s', 'max s', 'retrans', 'timeouts', 'cpu s')
+        for clients in [int(c) for c in args.clients.split(',')]:
+            pid = start_tftp_server(directory, args)
+            before = resource.getrusage(resource.RUSAGE_CHILDREN)
+            start = time.time()
+            finished = run_tftp_level(clients, files, args)
+            elapsed = time.time() - start
+            stats = read_stats(args.port + 1)
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+            failed = [c for c in finished if c.failed or c.md5.hexdigest() != files[c.filename][1]]
+            latencies = [c.finished - c.started for c in finished if c not in failed]
+            total = sum(c.size for c in finished if c not in failed)
+            cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+            print '{0:>7} {1:>6} {2:>10.2f} {3:>8.3f} {4:>8.3f} {5:>8.3f} {6:>8.3f} {7:>9.0f} {8:>8.0f} {9:>7.2f}'.format(
+                clients, len(failed), total / elapsed / 1024 ** 2,
+                percentile(latencies, 0.5), percentile(latencies, 0.9),
+                percentile(latencies, 0.99), max(latencies or [float('nan')]),
+                stats['tftp_retransmits_total'], stats['tftp_timeouts_total'], cpu)
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(directory)
+
+def bench_tftp_large(args):
+    directory = tempfile.mkdtemp(prefix = 'pypxe-bench-')
+    try:
+        name = 'file-{0}'.format(args.size)
+        size = parse_size(args.size)
+        with open(os.path.join(directory, name), 'wb') as f:
+            md5 = hashlib.md5()
+            # repeat a random chunk, generating hundreds of MB takes a while
+            chunk = os.urandom(1024 * 1024 + 1)
+            remaining = size
+            while remaining:
+                data = chunk[:min(remaining, len(chunk))]
+                md5.update(data)
+                f.write(data)
+                remaining -= len(data)
+        files = {name: (size, md5.hexdigest())}
+
+        print '{0:>7} {1:>8} {2:>9} {3:>6} {4:>6} {5:>10} {6:>8} {7:>9} {8:>7}'.format(
+            'blksize', 'rollover', 'blocks', 'wraps', 'failed', 'MiB/s', 'time s', 'retrans', 'cpu s')
+        failures = 0
+        for blksize in [int(b) for b in args.blksizes.split(',')]:
+            for rollover in [int(r) for r in args.rollovers.split(',')]:
+                run = argparse.Namespace(**vars(args))
+                run.blksize, run.rollover = blksize, rollover
+                pid = start_tftp_server(directory, run)
+                before = resource.getrusage(resource.RUSAGE_CHILDREN)
+                start = time.time()
+                finished = run_tftp_level(args.clients, files, run)
+                elapsed = time.time() - start
+                stats = read_stats(args.port + 1)
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+                after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+                failed = [c for c in finished if c.failed or c.size != size or c.md5.hexdigest() != files[name][1]]
+                failures += len(failed)
+                total = sum(c.size for c in finished if c not in failed)
+                blocks = size // blksize + 1
+                cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+                print '{0:>7} {1:>8} {2:>9} {3:>6} {4:>6} {5:>10.2f} {6:>8.2f} {7:>9.0f} {8:>7.2f}'.format(
+                    blksize, rollover, blocks, blocks // 65536, len(failed), total / elapsed / 1024 ** 2,
+                    elapsed, stats['tftp_retransmits_total'], cpu)
+                sys.stdout.flush()
+        if failures:
+            sys.exit('{0} transfers failed or were corrupted'.format(failures))
+    finally:
+        shutil.rmtree(directory)
+
+def bench_dhcp_alloc(args):
+    print '{0:>7} {1:>10} {2:>10} {3:>10}'.format('leases', 'fill us', 'expired us', 'churn us')
+    for leases in [int(l) for l in args.leases.split(',')]:
+        pool = dhcp.LeasePool(args.offer_from, args.offer_to)
+        now = time.time()
+        start = time.time()
+        held = [pool.allocate(i, now + 3600, now) for i in xrange(leases)]
+        fill = (time.time() - start) / leases
+
+        # every lease has expired, reclaiming them is spread over the next allocations
+        now += 7200
+        start = time.time()
+        held = [pool.allocate(i, now + 3600, now) for i in xrange(leases)]
+        expired = (time.time() - start) / leases
+
+        # steady state, a client leaves for every one that arrives
+        random.seed(leases)
+        start = time.time()
+        for i in xrange(args.rounds):
+            index = random.randrange(len(held))
+            held[index], held[-1] = held[-1], held[index]
+            pool.release(held.pop())
+            held.append(pool.allocate(leases + i, now + 3600, now))
+        churn = (time.time() - start) / args.rounds
+
+        print '{0:>7} {1:>10.2f} {2:>10.2f} {3:>10.2f}'.format(leases, fill * 1e6, expired * 1e6, churn * 1e6)
+        sys.stdout.flush()
+
+def bench_dhcp_store(args):
+    print '{0:>7} {1:>10} {2:>10} {3:>10} {4:>10} {5:>10}'.format('leases', 'record us', 'churn us', 'worst ms', 'load s', 'file KiB')
+    for leases in [int(l) for l in args.leases.split(',')]:
+        directory = tempfile.mkdtemp(prefix = 'pypxe-bench-')
+        try:
+            path = os.path.join(directory, 'leases')
+            store = dhcp.LeaseStore(path, sync_interval = args.sync_interval)
+            pool = dhcp.LeasePool(args.offer_from, args.offer_to)
+            expire = time.time() + 3600
+            macs = [struct.pack('!HI', 0x5254, i) for i in xrange(leases)]
+            ips = [pool.allocate(mac, expire) for mac in macs]
+            start = time.time()
+            for mac, ip in zip(macs, ips):
+                store.record(mac, ip, expire)
+            record = (time.time() - start) / leases
+
+            # the same clients coming back, piling up records to compact;
+            # the slowest record is what a DHCP answer may wait for
+            worst = 0
+            start = last = time.time()
+            for i in xrange(args.rounds):
+                index = i % leases
+                store.record(macs[index], ips[index], expire + i)
+                now = time.time()
+                worst = max(worst, now - last)
+                last = now
+            churn = (time.time() - start) / args.rounds
+            store.sync()
+
+            # a restart, as DHCPD restores leases
+            start = time.time()
+            with dhcp.paused_gc():
+                pool = dhcp.LeasePool(args.offer_from, args.offer_to)
+                restored = pool.restore(dhcp.LeaseStore(path, sync_interval = 0).load())
+            load = time.time() - start
+            if len(restored) != leases:
+                sys.exit('Restored {0} of {1} leases'.format(len(restored), leases))
+
+            size = sum(os.path.getsize('{0}.{1}'.format(path, i)) for i in (0, 1))
+            print '{0:>7} {1:>10.2f} {2:>10.2f} {3:>10.2f} {4:>10.3f} {5:>10.0f}'.format(leases, record * 1e6, churn * 1e6, worst * 1e3, load, size / 1024.0)
+            sys.stdout.flush()
+        finally:
+            shutil.rmtree(directory)
+
+class BenchDHCPD(dhcp.AbstractDHCPD):
+    def filename(self, client_mac):
+        return 'pxelinux.0'
+
+class ConcatenatedDHCPD(BenchDHCPD):
+    def craft_header(self, message, lease_time = dhcp.AbstractDHCPD.LEASE_TIME, subnet = None, siaddr = None):
+        '''Crafts the header by concatenation, as the DHCP server did before packing it whole.'''
+        xid, giaddr, chaddr = struct.unpack('!4x4s16x4s16s', message[:44])
+        client_mac = chaddr[:6]
+        response = struct.pack('!BBBB4s', 2, 1, 6, 0, xid)
+        response += struct.pack('!HHI', 0, 0, 0)
+        response += socket.inet_aton(self.lease_for(client_mac, lease_time, subnet).ip)
+        response += siaddr or self.siaddr
+        response += giaddr
+        response += chaddr
+        response += chr(0) * 64
+        response += chr(0) * 128
+        response += self.magic
+        return (client_mac, response)
+
+class NullSocket(object):
+    def sendto(self, data, address):
+        return len(data)
+
+def bench_dhcp_build(args):
+    servers = []
+    for server_class in (ConcatenatedDHCPD, BenchDHCPD):
+        server = server_class(port = args.port, offer_from = '10.0.0.1', offer_to = '10.0.255.254', client_rate_limit = 0, logger = logging.getLogger('bench'))
+        server.sock.close()
+        server.sockets = dict([(NullSocket(), server.subnet)])
+        servers.append(server)
+    chaddrs = [struct.pack('!HI', 0x5254, i) + '\0' * 10 for i in xrange(args.clients)]
+
+    # whole DHCPDISCOVERs through handle(), with a fresh xid each so
+    # none is answered from the retransmission cache; interleaved
+    # rounds, keeping the best of each, as the first round runs slower
+    paths = (('concatenated', servers[0]), ('packed', servers[1]))
+    best = dict((name, float('inf')) for name, server in paths)
+    xid = 0
+    for round in xrange(args.rounds):
+        for name, server in paths:
+            [sock] = server.sockets
+            messages = []
+            for i in xrange(args.packets):
+                xid += 1
+                message = struct.pack('!BBBBI4x4x4x4x4x16s', 1, 1, 6, 0, xid, chaddrs[i % args.clients])
+                messages.append(message + '\0' * 192 + server.magic + '\x35\x01\x01\xff')
+            start = time.time()
+            for message in messages:
+                server.handle(sock, message, ('0.0.0.0', 68))
+            best[name] = min(best[name], time.time() - start)
+
+    print '{0:>12} {1:>12} {2:>8}'.format('path', 'packets/s', 'us')
+    for name, server in paths:
+        print '{0:>12} {1:>12.0f} {2:>8.2f}'.format(name, args.packets / best[name], best[name] / args.packets * 1e6)
+
+def parse_cli_arguments():
+    parser = argparse.ArgumentParser(description = 'Benchmark the PyPXE services on loopback', formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    benchmarks = parser.add_subparsers(title = 'benchmarks')
+
+    tftp_parser = benchmarks.add_parser('tftp', help = 'Concurrent PXE-like clients against the TFTP server', formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    tftp_parser.set_defaults(benchmark = bench_tftp)
+    tftp_parser.add_argument('--clients', action = 'store', dest = 'clients', help = 'Comma separated numbers of concurrent clients, each run against a fresh server', default = '1,10,100')
+    tftp_parser.add_argument('--sizes', action = 'store', dest = 'sizes', help = 'Comma separated file sizes (e.g. 40K,1M), clients are spread over the files', default = '40K,150K,1M')
+    tftp_parser.add_argument('--blksize', action = 'store', type = int, dest = 'blksize', help = 'blksize requested by the clients', default = 1428)
+    tftp_parser.add_argument('--windowsize', action = 'store', type = int, dest = 'windowsize', help = 'windowsize requested by the clients, 1 disables the option', default = 1)
+    tftp_parser.add_argument('--rollover', action = 'store', type = int, choices = (0, 1), dest = 'rollover', help = 'Block number following 65535', default = 0)
+    tftp_parser.add_argument('--loss', action = 'store', type = float, dest = 'loss', help = 'Fraction of packets the clients drop, both ways', default = 0.0)
+    tftp_parser.add_argument('--ramp', action = 'store', type = float, dest = 'ramp', help = 'Seconds over which the clients start', default = 0.0)
+    tftp_parser.add_argument('--timeout', action = 'store', type = float, dest = 'timeout', help = 'Initial retransmission timeout of the server', default = 5)
+    tftp_parser.add_argument('--client-timeout', action = 'store', type = float, dest = 'client_timeout', help = 'Seconds before a client re-sends its last packet', default = 2)
+    tftp_parser.add_argument('--rate-limit', action = 'store', dest = 'rate_limit', help = 'Bytes per second the server sends at most (e.g. 100M), none if unset', default = None)
+    tftp_parser.add_argument('--client-rate-limit', action = 'store', dest = 'client_rate_limit', help = 'Bytes per second the server sends each client at most', default = None)
+    tftp_parser.add_argument('--cache-size', action = 'store', dest = 'cache_size', help = 'Block cache size of the server', default = '64M')
+    tftp_parser.add_argument('--port', action = 'store', type = int, dest = 'port', help = 'Port of the TFTP server, the stats port is the next one', default = 16969)
+
+    large_parser = benchmarks.add_parser('tftp-large', help = 'Large files at large block sizes, checking block number rollover', formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    large_parser.set_defaults(benchmark = bench_tftp_large)
+    large_parser.add_argument('--size', action = 'store', dest = 'size', help = 'Size of the file transferred, above 512M blocks of 8K wrap', default = '600M')
+    large_parser.add_argument('--blksizes', action = 'store', dest = 'blksizes', help = 'Comma separated blksizes, each run against a fresh server', default = '8192,16384,32768,65464')
+    large_parser.add_argument('--rollovers', action = 'store', dest = 'rollovers', help = 'Comma separated block numbers following 65535 (0 or 1) to run with', default = '0,1')
+    large_parser.add_argument('--clients', action = 'store', type = int, dest = 'clients', help = 'Number of concurrent clients', default = 1)
+    large_parser.add_argument('--windowsize', action = 'store', type = int, dest = 'windowsize', help = 'windowsize requested by the clients, 1 disables the option', default = 4)
+    large_parser.add_argument('--loss', action = 'store', type = float, dest = 'loss', help = 'Fraction of packets the clients drop, both ways', default = 0.0)
+    large_parser.add_argument('--ramp', action = 'store', type = float, dest = 'ramp', help = 'Seconds over which the clients start', default = 0.0)
+    large_parser.add_argument('--timeout', action = 'store', type = float, dest = 'timeout', help = 'Initial retransmission timeout of the server', default = 5)
+    large_parser.add_argument('--client-timeout', action = 'store', type = float, dest = 'client_timeout', help = 'Seconds before a client re-sends its last packet', default = 2)
+    large_parser.add_argument('--rate-limit', action = 'store', dest = 'rate_limit', help = 'Bytes per second the server sends at most (e.g. 100M), none if unset', default = None)
+    large_parser.add_argument('--client-rate-limit', action = 'store', dest = 'client_rate_limit', help = 'Bytes per second the server sends each client at most', default = None)
+    large_parser.add_argument('--cache-size', action = 'store', dest = 'cache_size', help = 'Block cache size of the server', default = '64M')
+    large_parser.add_argument('--port', action = 'store', type = int, dest = 'port', help = 'Port of the TFTP server, the stats port is the next one', default = 16969)
+
+    alloc_parser = benchmarks.add_parser('dhcp-alloc', help = 'DHCP address allocation with increasing numbers of leases', formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    alloc_parser.set_defaults(benchmark = bench_dhcp_alloc)
+    alloc_parser.add_argument('--leases', action = 'store', dest = 'leases', help = 'Comma separated numbers of leases held, each run against a fresh pool', default = '100,1000,10000,65000')
+    alloc_parser.add_argument('--rounds', action = 'store', type = int, dest = 'rounds', help = 'Allocations timed with the leases held', default = 10000)
+    alloc_parser.add_argument('--begin', action = 'store', dest = 'offer_from', help = 'Lease range start', default = '10.0.0.1')
+    alloc_parser.add_argument('--end', action = 'store', dest = 'offer_to', help = 'Lease range end', default = '10.0.255.254')
+
+    store_parser = benchmarks.add_parser('dhcp-store', help = 'Recording and restoring DHCP leases with increasing numbers of leases', formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    store_parser.set_defaults(benchmark = bench_dhcp_store)
+    store_parser.add_argument('--leases', action = 'store', dest = 'leases', help = 'Comma separated numbers of leases stored, each run against a fresh store', default = '1000,10000,100000')
+    store_parser.add_argument('--rounds', action = 'store', type = int, dest = 'rounds', help = 'Renewals recorded after the leases', default = 200000)
+    store_parser.add_argument('--sync-interval', action = 'store', type = float, dest = 'sync_interval', help = 'Seconds between fsyncs of the store', default = 1)
+    store_parser.add_argument('--begin', action = 'store', dest = 'offer_from', help = 'Lease range start', default = '10.0.0.1')
+    store_parser.add_argument('--end', action = 'store', dest = 'offer_to', help = 'Lease range end', default = '10.3.255.254')
+
+    build_parser = benchmarks.add_parser('dhcp-build', help = 'Answering DHCP discoveries with headers packed whole against concatenated', formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    build_parser.set_defaults(benchmark = bench_dhcp_build)
+    build_parser.add_argument('--packets', action = 'store', type = int, dest = 'packets', help = 'Discoveries answered per path and round', default = 100000)
+    build_parser.add_argument('--rounds', action = 'store', type = int, dest = 'rounds', help = 'Rounds of each path, the best is reported', default = 5)
+    build_parser.add_argument('--clients', action = 'store', type = int, dest = 'clients', help = 'Clients the responses are spread over', default = 1000)
+    build_parser.add_argument('--port', action = 'store', type = int, dest = 'port', help = 'Port the DHCP server binds, no packets are sent', default = 16767)
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    try:
+        args = parse_cli_arguments()
+        args.benchmark(args)
+    except KeyboardInterrupt:
+        sys.exit('\nInterrupted\n')
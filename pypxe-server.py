@@ -5,6 +5,7 @@ import sys
 import json
 import logging
 import logging.handlers
+import signal
 
 try:
     import argparse
@@ -16,6 +17,7 @@ from pypxe import tftp # PyPXE TFTP service
 from pypxe import dhcp # PyPXE DHCP service
 from pypxe import http # PyPXE HTTP service
 from pypxe import nbd  # PyPXE NBD service
+from pypxe import trace # PyPXE packet tracing
 
 # default settings
 SETTINGS = {'NETBOOT_DIR':'netboot',
@@ -29,6 +31,9 @@ SETTINGS = {'NETBOOT_DIR':'netboot',
             'DHCP_ROUTER':'192.168.2.1',
             'DHCP_BROADCAST':'<broadcast>',
             'DHCP_FILESERVER':'192.168.2.2',
+            'DHCP_LEASES':'',
+            'DHCP_SUBNETS':[],
+            'DHCP_INTERFACE':'',
             'SYSLOG_SERVER':None,
             'SYSLOG_PORT':514,
             'USE_IPXE':False,
@@ -43,7 +48,9 @@ SETTINGS = {'NETBOOT_DIR':'netboot',
             'NBD_COPY_TO_RAM':False,
             'NBD_SERVER_IP':'0.0.0.0',
             'NBD_PORT':10809,
-            'MODE_DEBUG':''}
+            'MODE_DEBUG':'',
+            'TRACE_FILE':'',
+            'TRACE_PACKETS':65536}
 
 def parse_cli_arguments():
     # main service arguments
@@ -63,9 +70,11 @@ def parse_cli_arguments():
 
     parser.add_argument('--debug', action = 'store', dest = 'MODE_DEBUG', help = 'Comma Seperated (http,tftp,dhcp). Adds verbosity to the selected services while they run. Use \'all\' for enabling debug on all services. Precede an option with \'-\' to disable debugging for that service; as an example, one can pass in the following to enable debugging for all services except the DHCP service: \'--debug all,-dhcp\'', default = SETTINGS['MODE_DEBUG'])
     parser.add_argument('--config', action = 'store', dest = 'JSON_CONFIG', help = 'Configure from a JSON file rather than the command line', default = '')
-    parser.add_argument('--static-config', action = 'store', dest = 'STATIC_CONFIG', help = 'Configure leases from a json file rather than the command line', default = '')
+    parser.add_argument('--static-config', action = 'store', dest = 'STATIC_CONFIG', help = 'Configure leases and TFTP templates from a json file rather than the command line', default = '')
     parser.add_argument('--syslog', action = 'store', dest = 'SYSLOG_SERVER', help = 'Syslog server', default = SETTINGS['SYSLOG_SERVER'])
     parser.add_argument('--syslog-port', action = 'store', dest = 'SYSLOG_PORT', help = 'Syslog server port', default = SETTINGS['SYSLOG_PORT'])
+    parser.add_argument('--trace', action = 'store', dest = 'TRACE_FILE', help = 'Trace DHCP and TFTP packets, writing the last --trace-packets of them to this pcap file on SIGUSR1', default = SETTINGS['TRACE_FILE'])
+    parser.add_argument('--trace-packets', action = 'store', type = int, dest = 'TRACE_PACKETS', help = 'Number of packets kept for --trace', default = SETTINGS['TRACE_PACKETS'])
 
 
     # DHCP server arguments
@@ -84,6 +93,9 @@ def parse_cli_arguments():
     dhcp_group.add_argument('--dhcp-dns', action = 'store', dest = 'DHCP_DNS', help = 'DHCP lease DNS server', default = SETTINGS['DHCP_DNS'])
     dhcp_group.add_argument('--dhcp-broadcast', action = 'store', dest = 'DHCP_BROADCAST', help = 'DHCP broadcast address', default = SETTINGS['DHCP_BROADCAST'])
     dhcp_group.add_argument('--dhcp-fileserver', action = 'store', dest = 'DHCP_FILESERVER', help = 'DHCP fileserver IP', default = SETTINGS['DHCP_FILESERVER'])
+    dhcp_group.add_argument('--dhcp-leases', action = 'store', dest = 'DHCP_LEASES', help = 'Keep DHCP leases across restarts in files with this path prefix', default = SETTINGS['DHCP_LEASES'])
+    dhcp_group.add_argument('--dhcp-interface', action = 'store', dest = 'DHCP_INTERFACE', help = 'Interface the DHCP lease range is served on, needed when --dhcp-subnets have one', default = SETTINGS['DHCP_INTERFACE'])
+    dhcp_group.add_argument('--dhcp-subnets', action = 'store', type = json.loads, dest = 'DHCP_SUBNETS', help = 'JSON list of further subnets to serve, on other interfaces or behind relay agents', default = SETTINGS['DHCP_SUBNETS'])
     dhcp_group.add_argument('--dhcp-whitelist', action = 'store_true', dest = 'DHCP_WHITELIST', help = 'Only respond to DHCP clients present in --static-config', default = False)
 
     # network boot directory and file name arguments
@@ -146,6 +158,35 @@ if __name__ == '__main__':
         else:
             loaded_statics = dict()
 
+        # opened now for the same reason
+        lease_store = None
+        if args.DHCP_LEASES:
+            try:
+                lease_store = dhcp.LeaseStore(args.DHCP_LEASES)
+            except OSError as e:
+                sys.exit('Failed to open {0}: {1}'.format(args.DHCP_LEASES, e.strerror))
+
+        # opened now for the same reason, and rewritten on every SIGUSR1
+        packet_trace = None
+        if args.TRACE_FILE:
+            try:
+                trace_file = open(args.TRACE_FILE, 'wb')
+            except IOError as e:
+                sys.exit('Failed to open {0}: {1}'.format(args.TRACE_FILE, e.strerror))
+            packet_trace = trace.PacketTrace(args.TRACE_PACKETS)
+            packet_trace.dump_on(signal.SIGUSR1, trace_file)
+
+        # the DHCP server reloads the static config when it changes, from
+        # within the chroot of the TFTP server to the netboot directory
+        static_config_file = None
+        if args.STATIC_CONFIG:
+            static_config_file = os.path.abspath(args.STATIC_CONFIG)
+            netboot_dir = os.path.abspath(args.NETBOOT_DIR) + os.sep
+            if args.USE_TFTP and static_config_file.startswith(netboot_dir):
+                static_config_file = os.sep + static_config_file[len(netboot_dir):]
+            elif args.USE_TFTP:
+                static_config_file = None
+
         # setup main logger
         sys_logger = logging.getLogger('PyPXE')
         if args.SYSLOG_SERVER:
@@ -195,7 +236,7 @@ if __name__ == '__main__':
             sys_logger.info('Starting TFTP server...')
 
             # setup the thread
-            tftp_server = tftp.TFTPD(mode_debug = do_debug('tftp'), logger = tftp_logger)
+            tftp_server = tftp.TFTPD(mode_debug = do_debug('tftp'), static_config = loaded_statics, trace = packet_trace, logger = tftp_logger)
             tftpd = threading.Thread(target = tftp_server.listen)
             tftpd.daemon = True
             tftpd.start()
@@ -211,6 +252,9 @@ if __name__ == '__main__':
             else:
                 sys_logger.info('Starting DHCP server...')
 
+            if args.STATIC_CONFIG and not static_config_file:
+                sys_logger.warning('{0} is outside the TFTP chroot, restart to apply changes to it'.format(args.STATIC_CONFIG))
+
             # setup the thread
             dhcp_server = dhcp.DHCPD(
                 ip = args.DHCP_SERVER_IP,
@@ -222,6 +266,8 @@ if __name__ == '__main__':
                 dns_server = args.DHCP_DNS,
                 broadcast = args.DHCP_BROADCAST,
                 file_server = args.DHCP_FILESERVER,
+                interface = args.DHCP_INTERFACE,
+                subnets = args.DHCP_SUBNETS,
                 file_name = args.NETBOOT_FILE,
                 use_ipxe = args.USE_IPXE,
                 use_http = args.USE_HTTP,
@@ -229,6 +275,9 @@ if __name__ == '__main__':
                 mode_debug = do_debug('dhcp'),
                 whitelist = args.DHCP_WHITELIST,
                 static_config = loaded_statics,
+                static_config_file = static_config_file,
+                lease_store = lease_store,
+                trace = packet_trace,
                 logger = dhcp_logger)
             dhcpd = threading.Thread(target = dhcp_server.listen)
             dhcpd.daemon = True
@@ -0,0 +1,446 @@
+'''
+
+This file contains classes that implement the PyPXE TFTP service on an
+asyncio event loop, as an alternative to the polling server in tftp.py
+
+'''
+
+import abc
+import socket
+import struct
+import os
+import time
+import logging
+
+try:
+    import asyncio
+except ImportError:
+    # python 2 needs the trollius backport
+    import trollius as asyncio
+
+from pypxe import tftp
+
+class AsyncClient(asyncio.DatagramProtocol, tftp.TransferOptions):
+    '''
+        A transfer on its own socket, see tftp.AbstractClient for the
+        protocol. Backends implement the same check_file, prepare_request
+        and next_block hooks, which may return coroutines or futures as
+        well as plain values.
+    '''
+
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, parent, message, address):
+        self.parent = parent
+        self.loop = parent.loop
+        self.stats = parent.stats
+        self.default_retries = parent.default_retries
+        self.rtt = tftp.RTTEstimator(parent.timeout, parent.min_timeout, parent.max_timeout)
+        self.start_time = time.time()
+        self.message = message
+        self.address = address
+        self.logger = parent.logger.getChild('Client.{0}'.format(address))
+        self.retries = self.default_retries
+        # time of the last valid ACK, retries are given up on by time too
+        self.ack_time = self.start_time
+        # highest block acknowledged by the client and the next block to send
+        self.acked = 0
+        self.block = 1
+        # highest block ever sent, and the (block, time) being timed
+        self.sent = 0
+        self.sample = None
+        # key is block number, blocks are read ahead of the window
+        self.prefetched = {}
+        self.reading = set()
+        # hook futures still running, cancelled if we complete first
+        self.pending = set()
+        self.blksize = 512
+        self.window = 1
+        self.sent_time = float('inf')
+        self.timer = None
+        self.transport = None
+        self.sending = False
+        self.dead = False
+        self.filesize = 0
+        self.filename = ''
+
+    @abc.abstractmethod
+    def check_file(self, filename):
+        '''Returns True if the file can be served, may be a coroutine.'''
+        pass
+
+    @abc.abstractmethod
+    def prepare_request(self, filename):
+        '''
+            Prepares the backend for serving the file and sets filesize,
+            may be a coroutine.
+        '''
+        pass
+
+    @abc.abstractmethod
+    def next_block(self, block):
+        '''Returns the data of the given (absolute) block number, may be a coroutine.'''
+        pass
+
+    def call(self, hook, args, callback, *extra):
+        '''
+            Calls a backend hook, then callback with its result and extra
+            once the coroutine or future it returned (if any) is done. A
+            hook that raises fails the transfer.
+        '''
+        try:
+            result = hook(*args)
+        except Exception as e:
+            self.backend_failed(e)
+            return
+        if not (asyncio.iscoroutine(result) or isinstance(result, asyncio.Future)):
+            callback(result, *extra)
+            return
+        future = asyncio.ensure_future(result, loop = self.loop)
+        self.pending.add(future)
+
+        def done(future):
+            self.pending.discard(future)
+            if self.dead or future.cancelled():
+                return
+            if future.exception() is not None:
+                self.backend_failed(future.exception())
+                return
+            callback(future.result(), *extra)
+        future.add_done_callback(done)
+
+    def backend_failed(self, error):
+        self.logger.error('Backend error: {0!r}'.format(error))
+        self.send_error(0, 'Read error', filename = self.filename)
+        self.complete()
+
+    def connection_made(self, transport):
+        '''Our socket is ready, so check the request.'''
+        self.transport = transport
+        self.parent.ongoing.add(self)
+        mode = self.message.split(chr(0))[1]
+        if mode != 'octet':
+            self.send_error(5, 'Mode {0} not supported'.format(mode))
+            self.complete()
+            return
+        filename = self.message.split(chr(0))[0]
+        self.call(self.check_file, (filename,), self.file_checked, filename)
+
+    def file_checked(self, exists, filename):
+        if not exists:
+            self.send_error(1, 'File Not Found', filename = filename)
+            self.complete()
+            return
+        self.filename = filename
+        self.logger.info('New request for "{0}"'.format(self.filename))
+        self.call(self.prepare_request, (self.filename,), self.start_transfer)
+
+    def start_transfer(self, _):
+        '''Once the backend is ready, sends either the OACK or the first block.'''
+        self.stats.transfers += 1
+        if not self.parse_options():
+            self.send_window()
+            return
+        # multicast is only offered by the polling server
+        self.options.pop('multicast', None)
+        self.transport.sendto(self.oack(), self.address)
+        # a resent OACK is not timed, so its ACK gives a valid first sample
+        self.sample = (0, time.time())
+        self.sent_time = self.sample[1]
+        self.schedule()
+
+    def read_ahead(self):
+        '''Starts reading the blocks up to readahead past the window.'''
+        last = min(self.block + self.window + self.parent.readahead, self.lastblock + 1)
+        for block in xrange(self.block, last):
+            if self.dead:
+                return
+            if block not in self.prefetched and block not in self.reading:
+                self.reading.add(block)
+                self.call(self.next_block, (block,), self.block_read, block)
+
+    def block_read(self, data, block):
+        self.reading.discard(block)
+        if data is None:
+            self.send_error(0, 'Read error', filename = self.filename)
+            self.complete()
+            return
+        if block > self.acked:
+            self.prefetched[block] = data
+            self.send_window()
+
+    def send_window(self):
+        '''
+            Sends every block of the current window that has been read and
+            not sent yet; see RFC7440.
+        '''
+        if self.sending:
+            # a hook returned a block straight away, the loop below sends it
+            return
+        self.sending = True
+        last = min(self.acked + self.window, self.lastblock)
+        while not self.dead:
+            while self.block <= last and self.block in self.prefetched:
+                self.send_block(self.block)
+                if self.block > self.sent:
+                    # only time blocks sent once, see Karn's algorithm
+                    if self.sample is None:
+                        self.sample = (self.block, self.sent_time)
+                    self.sent = self.block
+                self.block += 1
+            self.read_ahead()
+            if self.block > last or self.block not in self.prefetched:
+                break
+        self.sending = False
+
+    def send_block(self, block):
+        '''Sends a single block of data, setting the timeout accordingly.'''
+        data = self.prefetched[block]
+        # opcode 3 == DATA, wraparound block number
+        self.transport.sendto(tftp.DATA_HEADER.pack(3, self.wire_block(block)) + data, self.address)
+        self.logger.debug('Sending block {0}'.format(block))
+        self.stats.blocks_sent += 1
+        self.stats.bytes_sent += len(data)
+        if block <= self.sent:
+            self.stats.retransmits += 1
+        self.sent_time = time.time()
+        self.schedule()
+
+    def schedule(self):
+        '''
+            Makes sure a timer is pending. As in the polling server it is not
+            moved when we send again, but re-armed when it fires early.
+        '''
+        if self.timer is None:
+            self.timer = self.loop.call_later(max(0, self.sent_time + self.rtt.timeout - time.time()), self.timed_out)
+
+    def timed_out(self):
+        self.timer = None
+        if self.dead:
+            return
+        if self.sent_time + self.rtt.timeout > time.time():
+            self.schedule()
+            return
+        self.retries -= 1
+        self.stats.timeouts += 1
+        if self.retries <= 0 and time.time() - self.ack_time >= self.parent.timeout * self.default_retries:
+            self.logger.warning('Timed out sending "{0}"'.format(self.filename))
+            self.stats.failed += 1
+            self.complete()
+            return
+        self.rtt.backoff()
+        self.sample = None
+        if self.acked < 0:
+            # the OACK or its ACK was lost
+            self.transport.sendto(self.oack(), self.address)
+            self.sent_time = time.time()
+            self.schedule()
+            return
+        self.block = self.acked + 1
+        self.send_window()
+
+    def datagram_received(self, message, address):
+        if address != self.address:
+            return
+        [opcode] = struct.unpack('!H', message[:2])
+        if opcode == 5:
+            self.logger.info('Client aborted transfer of "{0}"'.format(self.filename))
+            self.stats.failed += 1
+            self.complete()
+            return
+        if opcode != 4:
+            return
+        [block] = struct.unpack('!H', message[2:4])
+        self.handle_ack(block)
+
+    def error_received(self, exc):
+        self.logger.debug('Socket error: {0}'.format(exc))
+
+    def send_error(self, code = 1, message = 'File Not Found', filename = ''):
+        '''Sends an error code and string to a client, see tftp.AbstractClient.send_error.'''
+        self.transport.sendto(struct.pack('!HH', 5, code) + message + chr(0), self.address)
+        self.logger.error('Sending {0}: {1} {2}'.format(code, message, filename))
+
+    def complete(self):
+        '''Closes our socket and cancels whatever the backend is still doing.'''
+        if self.dead:
+            return
+        self.dead = True
+        self.parent.ongoing.discard(self)
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        for future in list(self.pending):
+            future.cancel()
+        self.transport.close()
+
+
+class AsyncFileBackedClient(AsyncClient):
+    '''Client instance backed with local filesystem.'''
+
+    def __init__(self, parent, message, address):
+        super(AsyncFileBackedClient, self).__init__(parent, message, address)
+        self.fh = None
+        self.cache_key = None
+
+    def check_file(self, filename):
+        '''Determines if the file exist and if it is a file.'''
+        return os.path.lexists(filename) and os.path.isfile(filename)
+
+    def prepare_request(self, filename):
+        '''Open file handler in preparation for serving the file.'''
+        self.fh = open(filename, 'rb')
+        self.filesize = os.path.getsize(filename)
+        if self.parent.cache is not None:
+            self.cache_key = self.parent.cache.validate(filename, self.fh)
+
+    def next_block(self, block):
+        '''Return the data of the given (absolute) block number.'''
+        offset = (block - 1) * self.blksize
+        if self.cache_key is None:
+            self.fh.seek(offset)
+            return self.fh.read(self.blksize)
+        return self.parent.cache.read(self.cache_key, self.fh, offset, self.blksize)
+
+    def complete(self):
+        '''Closes a file after sending it.'''
+        super(AsyncFileBackedClient, self).complete()
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+
+class StatsProtocol(asyncio.Protocol):
+    '''Writes the stats to every connection on the stats port and closes it.'''
+    def __init__(self, parent):
+        self.parent = parent
+
+    def connection_made(self, transport):
+        transport.write(self.parent.stats.render(self.parent.stats.snapshot(self.parent)))
+        transport.close()
+
+
+class AsyncTFTPD(asyncio.DatagramProtocol):
+    '''
+        Read-only TFTP server like tftp.BaseTFTPD, on an asyncio event loop
+        so it can share the loop with other asyncio services and serve
+        coroutine backends without threads. Multicast and worker processes
+        are only supported by tftp.BaseTFTPD.
+    '''
+    def __init__(self, client_cls, loop = None, **server_settings):
+        self.ip = server_settings.get('ip', '0.0.0.0')
+        self.port = server_settings.get('port', 69)
+        self.mode_debug = server_settings.get('mode_debug', False) # debug mode
+        self.logger = server_settings.get('logger', None)
+        self.default_retries = server_settings.get('default_retries', 3)
+        self.timeout = server_settings.get('timeout', 5)
+        self.min_timeout = server_settings.get('min_timeout', 0.5)
+        self.max_timeout = server_settings.get('max_timeout', 30)
+        self.max_window = server_settings.get('max_window', 16)
+        self.block_rollover = server_settings.get('block_rollover', 0)
+        self.readahead = server_settings.get('readahead', 8)
+        self.stats_ip = server_settings.get('stats_ip', '127.0.0.1')
+        self.stats_port = server_settings.get('stats_port', None)
+        self.cache_size = server_settings.get('cache_size', 64 * 1024 * 1024)
+        self.cache_chunk_size = server_settings.get('cache_chunk_size', 1024 * 1024)
+        self.client_cls = client_cls
+        self.loop = loop
+
+        # setup logger
+        if self.logger == None:
+            self.logger = logging.getLogger('TFTP')
+            handler = logging.StreamHandler()
+            formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(name)s %(message)s')
+            handler.setFormatter(formatter)
+            self.logger.addHandler(handler)
+
+        if self.mode_debug:
+            self.logger.setLevel(logging.DEBUG)
+
+        self.logger.debug('NOTICE: TFTP server started in debug mode. TFTP server is using the following:')
+        self.logger.debug('Server IP: {0}'.format(self.ip))
+        self.logger.debug('Server Port: {0}'.format(self.port))
+        self.logger.debug('Retransmit Timeout: {0}s initially, {1}s - {2}s'.format(self.timeout, self.min_timeout, self.max_timeout))
+        self.logger.debug('Maximum Window Size: {0}'.format(self.max_window))
+        self.logger.debug('Block Number Rollover: to {0}'.format(self.block_rollover))
+        self.logger.debug('Reading ahead {0} blocks'.format(self.readahead))
+        if self.stats_port:
+            self.logger.debug('Stats: {0}:{1}'.format(self.stats_ip, self.stats_port))
+        self.logger.debug('Block Cache: {0} bytes in {1} byte chunks'.format(self.cache_size, self.cache_chunk_size))
+
+        self.cache = tftp.BlockCache(self.cache_size, self.cache_chunk_size) if self.cache_size else None
+        self.stats = tftp.TFTPStats()
+        self.ongoing = set()
+        # never used, but counted in the stats
+        self.multicast = {}
+        self.transport = None
+
+    def endpoint(self, factory, port):
+        '''Returns a coroutine creating a datagram endpoint bound to our IP and port.'''
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.ip, port))
+        try:
+            return self.loop.create_datagram_endpoint(factory, sock = sock)
+        except TypeError:
+            # trollius only takes an address
+            sock.close()
+            return self.loop.create_datagram_endpoint(factory, local_addr = (self.ip, port))
+
+    def start(self):
+        '''Returns a future that is done once the server is listening on the loop.'''
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        tasks = [self.endpoint(lambda: self, self.port)]
+        if self.stats_port:
+            tasks.append(self.loop.create_server(lambda: StatsProtocol(self), self.stats_ip, self.stats_port))
+        return asyncio.gather(*tasks, loop = self.loop)
+
+    def listen(self):
+        '''
+            Runs the server on its own event loop until the process exits,
+            like tftp.BaseTFTPD.listen. Use start() to share a loop instead.
+        '''
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.start())
+        self.loop.run_forever()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, message, address):
+        '''Starts a transfer on a new socket for every read request.'''
+        try:
+            [opcode] = struct.unpack('!H', message[:2])
+        except struct.error:
+            return
+        if opcode != 1:
+            return
+        self.logger.getChild('Client.{0}'.format(address)).debug('Recieving request...')
+        factory = lambda: self.client_cls(self, message[2:], address)
+        asyncio.ensure_future(self.endpoint(factory, 0), loop = self.loop).add_done_callback(self.endpoint_made)
+
+    def endpoint_made(self, future):
+        if future.exception() is not None:
+            self.logger.error('Could not open transfer socket: {0}'.format(future.exception()))
+
+    def error_received(self, exc):
+        self.logger.debug('Socket error: {0}'.format(exc))
+
+
+class TFTPD(AsyncTFTPD):
+    '''
+        Implemention of the asyncio TFTP class with local filesystem as
+        backing storage.
+    '''
+    def __init__(self, loop = None, **server_settings):
+        super(TFTPD, self).__init__(AsyncFileBackedClient, loop, **server_settings)
+        self.netbook_directory = server_settings.get('netbook_directory', '.')
+        self.logger.debug('Network Boot Directory: {0}'.format(self.netbook_directory))
+
+        # start in network boot file directory and then chroot,
+        # this simplifies target later as well as offers a slight security increase
+        os.chdir (self.netbook_directory)
+        os.chroot ('.')
@@ -8,9 +8,21 @@ import abc
 import socket
 import struct
 import os
+import gc
+import json
+import json.scanner
+import heapq
+import select
 import logging
-from collections import defaultdict
-from time import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import time, sleep
+
+
+# op, htype, hlen, hops, xid, secs and flags, ciaddr, yiaddr, siaddr, giaddr,
+# chaddr, BOOTP legacy pad and magic cookie of a BOOTP reply
+REPLY_HEADER = struct.Struct('!BBBB4s8x4s4s4s16s192x4s')
 
 
 class Error(Exception):
@@ -21,6 +33,405 @@ class OutOfLeasesError(Error):
     pass
 
 
+def encode_ip(ip):
+    '''Converts a dotted quad to a 32-bit integer, e.g. '192.168.1.1' to 3232235777.'''
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def decode_ip(ip):
+    '''Converts a 32-bit integer to a dotted quad, e.g. 3232235777 to '192.168.1.1'.'''
+    return socket.inet_ntoa(struct.pack('!I', ip))
+
+
+@contextmanager
+def paused_gc():
+    '''
+        Holds off the cyclic garbage collector, which would otherwise
+        rescan the objects created so far over and over while
+        hundreds of thousands of leases are loaded.
+    '''
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class LeasePool(object):
+    '''
+        Hands out the addresses of a range without scanning it.
+        Addresses past a cursor have never been leased, so only
+        released addresses need indexing, in a min-heap so the lowest
+        is reused first. Expiry times are kept in a second min-heap
+        and expired leases are reclaimed when the next address is
+        needed; entries of addresses released early are skipped then,
+        and those of renewed leases pushed back to their new expiry.
+    '''
+
+    def __init__(self, offer_from, offer_to, reserved = ()):
+        self.first = encode_ip(offer_from)
+        self.last = encode_ip(offer_to)
+        self.cursor = self.first
+        self.free = []
+        self.expiries = []
+        self.owners = {} # address -> (owner, expire)
+        self.reserved = set()
+        for ip in reserved:
+            self.reserve(ip)
+
+    def __len__(self):
+        '''Returns the number of addresses currently leased.'''
+        return len(self.owners)
+
+    def usable(self, address):
+        '''Addresses of the form X.Y.Z.0 are never leased.'''
+        return address % 256 and address not in self.reserved
+
+    def reserve(self, ip):
+        '''Keeps an address, e.g. a static binding, out of the pool.'''
+        self.reserved.add(encode_ip(ip))
+
+    def set_reserved(self, reserved):
+        '''
+            Replaces the set of reserved addresses; those no longer
+            reserved that the cursor passed go back to the pool, as they
+            were skipped rather than indexed.
+        '''
+        for address in self.reserved - reserved:
+            if self.first <= address < self.cursor and address % 256 and address not in self.owners:
+                heapq.heappush(self.free, address)
+        self.reserved = reserved
+
+    def reclaim(self, now):
+        '''Returns the addresses of leases expired by now to the pool, and their owners.'''
+        reclaimed = []
+        while self.expiries and self.expiries[0][0] <= now:
+            expire, address = heapq.heappop(self.expiries)
+            if address not in self.owners:
+                continue # released early
+            owner, current = self.owners[address]
+            if current == expire:
+                del self.owners[address]
+                heapq.heappush(self.free, address)
+                reclaimed.append(owner)
+            elif current > expire:
+                # renewed since, expires later; one entry per lease keeps the heap small
+                heapq.heappush(self.expiries, (current, address))
+        return reclaimed
+
+    def allocate(self, owner, expire, now = None):
+        '''Leases the lowest free address to owner until expire.'''
+        self.reclaim(time() if now is None else now)
+        address = None
+        while self.free:
+            candidate = heapq.heappop(self.free)
+            if self.usable(candidate) and candidate not in self.owners:
+                address = candidate
+                break
+        while address is None and self.cursor <= self.last:
+            if self.usable(self.cursor) and self.cursor not in self.owners:
+                address = self.cursor
+            self.cursor += 1
+        if address is None:
+            raise OutOfLeasesError('Ran out of IP addresses to lease!')
+        self.owners[address] = (owner, expire)
+        heapq.heappush(self.expiries, (expire, address))
+        return decode_ip(address)
+
+    def restore(self, leases):
+        '''
+            Leases the free addresses of {owner: (ip, expire)}, e.g. the
+            leases of a previous run; returns the leases restored.
+        '''
+        restored = {}
+        encode = encode_ip
+        for owner, (ip, expire) in leases.iteritems():
+            address = encode(ip)
+            if self.first <= address <= self.last and self.usable(address) and address not in self.owners:
+                self.owners[address] = (owner, expire)
+                self.expiries.append((expire, address))
+                restored[owner] = (ip, expire)
+        heapq.heapify(self.expiries)
+        return restored
+
+    def renew(self, ip, expire):
+        '''Extends the lease on ip until expire, if the pool leased it.'''
+        address = encode_ip(ip)
+        if address in self.owners:
+            self.owners[address] = (self.owners[address][0], expire)
+
+    def release(self, ip):
+        '''Returns ip to the pool straight away.'''
+        address = encode_ip(ip)
+        if self.owners.pop(address, None) is not None:
+            heapq.heappush(self.free, address)
+
+
+class Lease(object):
+    '''An address leased to a client until expire, from pool unless it is static.'''
+
+    __slots__ = ('ip', 'expire', 'pool')
+
+    def __init__(self, ip, expire, pool = None):
+        self.ip = ip
+        self.expire = expire
+        self.pool = pool
+
+
+class Subnet(object):
+    '''
+        A range of addresses handed out with options of its own, to
+        clients on interface, or behind a relay agent whose address
+        (giaddr) is in the subnet's network.
+    '''
+
+    def __init__(self, pool, subnet_mask, options, broadcast, interface = ''):
+        self.pool = pool
+        self.mask = encode_ip(subnet_mask)
+        self.network = pool.first & self.mask
+        self.options = options
+        self.broadcast = broadcast
+        self.interface = interface
+
+
+class ExpiringCache(object):
+    '''
+        Keeps values for ttl seconds, and at most capacity of them,
+        dropping the oldest first; for state that matters only briefly
+        but could be created by any packet.
+    '''
+
+    def __init__(self, capacity, ttl):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (expire, value), oldest first
+
+    def __len__(self):
+        return len(self.entries)
+
+    def set(self, key, value, now = None):
+        now = time() if now is None else now
+        self.entries.pop(key, None)
+        self.entries[key] = (now + self.ttl, value)
+        while len(self.entries) > self.capacity or self.entries[next(iter(self.entries))][0] <= now:
+            self.entries.popitem(last = False)
+
+    def get(self, key, default = None, now = None):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= (time() if now is None else now):
+            return default
+        return entry[1]
+
+    def clear(self):
+        self.entries.clear()
+
+
+class BootRules(object):
+    '''
+        Picks what a client boots from the options of its request. Each
+        rule is (archs, vendor class prefix, user class, boot, iPXE boot),
+        any of the first three None to match all clients, and the first
+        rule matching wins. A network only sees a handful of combinations
+        of these options, so what was picked for each is remembered.
+    '''
+
+    MEMO_SIZE = 1024
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.memo = {}
+
+    def __len__(self):
+        return len(self.rules)
+
+    def match(self, options):
+        '''Returns the (next server, encoded options) to boot the client with, None if no rule matches.'''
+        key = (options.get(93, ('',))[0], options.get(60, ('',))[0], options.get(77, ('',))[0])
+        try:
+            return self.memo[key]
+        except KeyError:
+            pass
+        client_archs, vendor_class, user_class = key
+        client_archs = [client_archs[i:i + 2] for i in xrange(0, len(client_archs), 2)]
+        boot = None
+        for archs, vendor_prefix, user, rule_boot, ipxe_boot in self.rules:
+            if archs is not None and not archs.intersection(client_archs):
+                continue
+            if vendor_prefix is not None and not vendor_class.startswith(vendor_prefix):
+                continue
+            if user is not None and user_class != user:
+                continue
+            boot = ipxe_boot if user_class == 'iPXE' else rule_boot
+            break
+        if len(self.memo) >= self.MEMO_SIZE: # options are up to the clients
+            self.memo.clear()
+        self.memo[key] = boot
+        return boot
+
+
+class LeaseStore(object):
+    '''
+        Keeps leases across restarts in two files, path.0 and path.1,
+        of fixed size records (MAC, IP, expiry). New leases are appended
+        to the active file, which a thread fsyncs every sync_interval
+        seconds, so a lease costs one write whatever the number of
+        leases. Once the file holds more than twice the live leases the
+        thread compacts them into the other file, which then becomes the
+        active one; the header with its generation is written last, so a
+        crash while compacting leaves the previous file in use. Both files are
+        opened up front, so the store keeps working after a chroot.
+    '''
+
+    HEADER = struct.Struct('!8sQ') # magic, generation
+    RECORD = struct.Struct('!6s4sd') # MAC, IP, expiry
+    MAGIC = 'PyPXELS1'
+
+    def __init__(self, path, sync_interval = 1, compact_after = 4096):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.compact_after = compact_after
+        self.lock = threading.Lock()
+        self.dirty = False
+        # records made while compacting, for the new file
+        self.compacting = None
+        # set when compaction is due
+        self.wakeup = threading.Event()
+        self.fds = [os.open('{0}.{1}'.format(path, i), os.O_RDWR | os.O_CREAT, 0600) for i in (0, 1)]
+
+        # continue with the newest complete file
+        generations = [self.generation(fd) for fd in self.fds]
+        self.active = 0 if generations[0] >= generations[1] else 1
+        self.current = max(generations)
+        self.leases = {}
+        self.records = 0
+        if self.current:
+            with paused_gc():
+                self.replay(self.fds[self.active])
+        else:
+            self.current = 1
+            self.write_header(self.fds[self.active], self.current)
+            os.fsync(self.fds[self.active])
+
+        if sync_interval:
+            syncer = threading.Thread(target = self.run_sync)
+            syncer.daemon = True
+            syncer.start()
+
+    def generation(self, fd):
+        '''Returns the generation of a file, 0 if it is empty or incomplete.'''
+        os.lseek(fd, 0, os.SEEK_SET)
+        header = os.read(fd, self.HEADER.size)
+        if len(header) < self.HEADER.size:
+            return 0
+        magic, generation = self.HEADER.unpack(header)
+        return generation if magic == self.MAGIC else 0
+
+    def write_header(self, fd, generation):
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, self.HEADER.pack(self.MAGIC, generation))
+
+    def replay(self, fd):
+        '''Loads the leases of a file; later records replace earlier ones.'''
+        size = os.fstat(fd).st_size
+        os.lseek(fd, self.HEADER.size, os.SEEK_SET)
+        data = os.read(fd, size - self.HEADER.size)
+        count = len(data) // self.RECORD.size
+        # unpacking a batch of records per call is much faster
+        batch = struct.Struct('!' + '6s4sd' * 1024)
+        leases = self.leases
+        end = count - count % 1024
+        for offset in xrange(0, end * self.RECORD.size, batch.size):
+            fields = batch.unpack_from(data, offset)
+            leases.update(zip(fields[0::3], zip(fields[1::3], fields[2::3])))
+        for offset in xrange(end * self.RECORD.size, count * self.RECORD.size, self.RECORD.size):
+            mac, ip, expire = self.RECORD.unpack_from(data, offset)
+            leases[mac] = (ip, expire)
+        self.records = count
+        # drop a record torn by a crash, so new ones line up
+        os.ftruncate(fd, self.HEADER.size + count * self.RECORD.size)
+        os.lseek(fd, 0, os.SEEK_END)
+
+    def load(self, now = None):
+        '''Returns {MAC: (IP, expiry)} of the leases not yet expired.'''
+        now = time() if now is None else now
+        return dict((mac, (socket.inet_ntoa(ip), expire)) for mac, (ip, expire) in self.leases.iteritems() if expire > now)
+
+    def record(self, mac, ip, expire):
+        '''Stores a lease of ip to the raw mac until expire, 0 releases it.'''
+        record = self.RECORD.pack(mac, socket.inet_aton(ip), expire)
+        with self.lock:
+            os.write(self.fds[self.active], record)
+            if self.compacting is not None:
+                self.compacting.append(record)
+            self.leases[mac] = (record[6:10], expire)
+            self.records += 1
+            self.dirty = True
+        if self.compaction_due():
+            if self.sync_interval:
+                self.wakeup.set()
+            else:
+                # without a thread to do it for us
+                self.compact()
+
+    def compaction_due(self):
+        return self.records > self.compact_after and self.records > 2 * len(self.leases)
+
+    def compact(self):
+        '''
+            Rewrites the live leases into the inactive file and switches to
+            it. The file is written and flushed without holding the lock,
+            records made meanwhile are appended once it is done.
+        '''
+        now = time()
+        with self.lock:
+            leases = self.leases.copy()
+            self.compacting = []
+            fd = self.fds[1 - self.active]
+        live = dict((mac, lease) for mac, lease in leases.iteritems() if lease[1] > now)
+        expired = [(mac, lease) for mac, lease in leases.iteritems() if lease[1] <= now]
+        os.ftruncate(fd, 0)
+        os.lseek(fd, 0, os.SEEK_SET)
+        pack = self.RECORD.pack
+        os.write(fd, '\0' * self.HEADER.size + ''.join(pack(mac, ip, expire) for mac, (ip, expire) in live.iteritems()))
+        os.fsync(fd)
+        with self.lock:
+            # the header goes last, the new file is flushed by the next sync
+            os.write(fd, ''.join(self.compacting))
+            self.write_header(fd, self.current + 1)
+            os.lseek(fd, 0, os.SEEK_END)
+            for mac, lease in expired:
+                if self.leases.get(mac) == lease:
+                    del self.leases[mac]
+            self.current += 1
+            self.active = 1 - self.active
+            self.records = len(live) + len(self.compacting)
+            self.compacting = None
+            self.dirty = True
+
+    def sync(self):
+        '''Flushes recorded leases to disk.'''
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            fd = self.fds[self.active]
+        # records keep being written meanwhile, the next sync flushes them
+        os.fsync(fd)
+
+    def run_sync(self):
+        synced = time()
+        while True:
+            self.wakeup.wait(max(0, synced + self.sync_interval - time()))
+            self.wakeup.clear()
+            if self.compaction_due():
+                self.compact()
+            if time() >= synced + self.sync_interval:
+                self.sync()
+                synced = time()
+
+
 class AbstractDHCPD(object):
     '''
         This class implements a DHCP Server, limited to PXE options.
@@ -31,6 +442,11 @@ class AbstractDHCPD(object):
 
     __metaclass__ = abc.ABCMeta
 
+    LEASE_TIME = 86400
+    OFFER_TIME = 60 # an OFFER holds an address until the client requests it
+    OPTIONS_CACHE_SIZE = 4096
+    RESPONSE_CACHE_SIZE = 4096
+
     def __init__(self, **server_settings):
 
         self.ip = server_settings.get('ip', '192.168.2.2')
@@ -44,9 +460,20 @@ class AbstractDHCPD(object):
         self.broadcast = server_settings.get('broadcast', '<broadcast>')
         self.file_server = server_settings.get('file_server', '192.168.2.2')
         self.static_config = server_settings.get('static_config', dict())
+        self.static_config_file = server_settings.get('static_config_file', None)
+        self.static_config_poll = server_settings.get('static_config_poll', 2)
+        self.whitelist = server_settings.get('whitelist', False)
+        self.lease_store = server_settings.get('lease_store', None)
+        self.max_leases = server_settings.get('max_leases', 65536)
+        self.client_rate_limit = server_settings.get('client_rate_limit', 2) # requests per second
+        self.client_burst = server_settings.get('client_burst', 10)
+        self.trace = server_settings.get('trace', None)
+        subnets = server_settings.get('subnets', [])
         self.mode_debug = server_settings.get('mode_debug', False) # debug mode
         self.logger = server_settings.get('logger', None)
         self.magic = struct.pack('!I', 0x63825363) # magic cookie
+        self.siaddr = socket.inet_aton(self.file_server)
+        self.file_server_option = self.tlv_encode(66, str(self.file_server))
 
         # setup logger
         if self.logger == None:
@@ -68,58 +495,287 @@ class AbstractDHCPD(object):
         self.logger.debug('DNS Server: {0}'.format(self.dns_server))
         self.logger.debug('Broadcast Address: {0}'.format(self.broadcast))
 
+        # remember the version loaded, changes after it are reloaded
+        if self.static_config_file:
+            self.static_signature = self.stat_static_config()
+            if not self.static_config:
+                self.static_config = self.read_static_config()
+
         if self.static_config:
             self.logger.debug('Using Static Leasing')
             self.logger.debug('Using Static Leasing Whitelist: {0}'.format(self.whitelist))
 
         self.logger.debug('File Server IP: {0}'.format(self.file_server))
+        if self.static_config_file:
+            self.logger.debug('Reloading {0} on changes, checked every {1}s'.format(self.static_config_file, self.static_config_poll))
+        self.logger.debug('Max Leases: {0}'.format(self.max_leases))
+        if self.client_rate_limit:
+            self.logger.debug('Rate Limit: {0} requests/s per client, {1} request bursts'.format(self.client_rate_limit, self.client_burst))
+        if self.lease_store:
+            self.logger.debug('Lease Store: {0}'.format(self.lease_store.path))
+        if subnets:
+            self.logger.debug('Further Subnets: {0}'.format(', '.join('{0} - {1}'.format(s['offer_from'], s['offer_to']) for s in subnets)))
+
+        # key is MAC, only clients that were handed an address have a lease
+        self.leases = {}
+
+        # options of recent requests, for filename() and friends
+        self.client_options = ExpiringCache(self.OPTIONS_CACHE_SIZE, self.OFFER_TIME)
+
+        # responses sent, key is (MAC, xid, message type), so
+        # retransmissions are answered without crafting them again;
+        # a replayed OFFER still holds its address
+        self.responses = ExpiringCache(self.RESPONSE_CACHE_SIZE, self.OFFER_TIME)
+
+        # key is MAC, value is (tokens, time of last request); an empty
+        # bucket is full again after client_burst / client_rate_limit seconds
+        if self.client_rate_limit:
+            self.client_buckets = ExpiringCache(self.OPTIONS_CACHE_SIZE, float(self.client_burst) / self.client_rate_limit)
+
+        # key is raw MAC, value is (IP, encoded options)
+        self.bindings, self.default_options = self.compile_static(self.static_config)
+        self.boot_rules = self.compile_boot_rules(self.static_config)
+        self.logger.debug('Boot Rules: {0}'.format(len(self.boot_rules)))
 
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        # statically bound addresses are never handed out from a range
+        reserved = [ip for ip, options in self.bindings.itervalues() if ip]
+        self.pool = LeasePool(self.offer_from, self.offer_to, reserved)
+        self.subnet = Subnet(self.pool, self.subnet_mask, self.default_options, self.broadcast, self.interface)
+        self.subnets = [self.subnet] + [self.make_subnet(settings, reserved) for settings in subnets]
+
+        # relayed requests get the subnet holding their giaddr, key is
+        # (mask, network); the first subnet given wins, longest mask first
+        self.networks = dict(((subnet.mask, subnet.network), subnet) for subnet in reversed(self.subnets))
+        self.masks = sorted(set(subnet.mask for subnet in self.subnets), reverse = True)
+
+        # other requests get the subnet of the interface they came in on;
+        # a socket bound to no device also gets the broadcasts of the
+        # others, which would then be answered twice, and maybe from the
+        # wrong subnet, so the first subnet needs its own interface too
+        if not self.interface and any(subnet.interface for subnet in self.subnets[1:]):
+            raise Error('interface must be given when further subnets have one')
+        self.sock = self.bind(self.interface)
+        self.sockets = OrderedDict([(self.sock, self.subnet)])
+        for subnet in self.subnets[1:]:
+            if not subnet.interface:
+                self.logger.debug('Subnet {0} - {1} is served through relay agents only'.format(
+                    decode_ip(subnet.pool.first), decode_ip(subnet.pool.last)))
+            elif subnet.interface in [s.interface for s in self.sockets.itervalues()]:
+                self.logger.warning('Subnet {0} - {1} is only served through relay agents, interface {2} already has one'.format(
+                    decode_ip(subnet.pool.first), decode_ip(subnet.pool.last), subnet.interface))
+            else:
+                self.sockets[self.bind(subnet.interface)] = subnet
+
+        # pick up the leases of a previous run that the ranges still hold
+        if self.lease_store:
+            with paused_gc():
+                stored = self.lease_store.load()
+                # clients bound to an address since get that one instead
+                for client_mac in [mac for mac in stored if mac in self.bindings and self.bindings[mac][0]]:
+                    self.lease_store.record(client_mac, stored.pop(client_mac)[0], 0)
+                for subnet in self.subnets:
+                    for client_mac, (ip, expire) in subnet.pool.restore(stored).iteritems():
+                        self.leases[client_mac] = Lease(ip, expire, subnet.pool)
+            self.logger.info('Restored {0} of {1} stored leases'.format(len(self.leases), len(stored)))
+
+        # a static configuration compiled by the watcher, for listen to swap in
+        self.reloaded = None
+        self.reload_lock = threading.Lock()
+        if self.static_config_file:
+            watcher = threading.Thread(target = self.watch_static_config)
+            watcher.daemon = True
+            watcher.start()
+
+    def bind(self, interface):
+        '''Returns a new socket bound to the DHCP port on interface, or all of them if empty.'''
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         # SO_BINDTODEVICE
-        self.sock.setsockopt(socket.SOL_SOCKET, 25, self.interface + '\0')
-        self.sock.bind(('', self.port))
+        sock.setsockopt(socket.SOL_SOCKET, 25, interface + '\0')
+        sock.bind(('', self.port))
+        if self.trace:
+            self.trace.attach(sock, (self.ip, self.port))
+        return sock
 
-        # key is MAC
-        self.leases = defaultdict(lambda: {'ip': '', 'expire': 0})
+    def make_subnet(self, settings, reserved):
+        '''
+            Creates a further subnet from a dict of its offer_from and
+            offer_to, and optionally subnet_mask, router, dns_server,
+            broadcast and interface.
+        '''
+        subnet_mask = str(settings.get('subnet_mask', '255.255.255.0'))
+        network = encode_ip(settings['offer_from']) & encode_ip(subnet_mask)
+        router = str(settings.get('router', decode_ip(network + 1)))
+        broadcast = str(settings.get('broadcast', decode_ip(network | ~encode_ip(subnet_mask) & 0xffffffff)))
+        options = self.encode_options(subnet_mask, router, [str(settings.get('dns_server', self.dns_server))])
+        pool = LeasePool(str(settings['offer_from']), str(settings['offer_to']), reserved)
+        return Subnet(pool, subnet_mask, options, broadcast, str(settings.get('interface', '')))
 
-    def get_namespaced_static(self, path, fallback = {}):
-        statics = self.static_config
-        for child in path.split('.'):
-            statics = statics.get(child, {})
-        return statics if statics else fallback
+    def encode_options(self, subnet_mask, router, dns_servers):
+        '''Encodes the options that are the same in every OFFER and ACK to a client.'''
+        options = self.tlv_encode(54, socket.inet_aton(self.ip)) # DHCP Server
+        options += self.tlv_encode(1, socket.inet_aton(subnet_mask)) # subnet mask
+        options += self.tlv_encode(3, socket.inet_aton(router)) # router
+        options += self.tlv_encode(6, ''.join([socket.inet_aton(i) for i in dns_servers]))
+        options += self.tlv_encode(51, struct.pack('!I', self.LEASE_TIME)) # lease time
+        return options
 
-    def next_ip(self):
+    def compile_static(self, static_config):
         '''
-            This method returns the next unleased IP from range;
-            also does lease expiry by overwrite.
+            Compiles the dhcp.binding section of a static configuration
+            into a dict keyed by raw MAC of (IP, encoded options), and
+            the encoded options of clients without a binding, so
+            crafting a response only needs a lookup.
         '''
+        bindings = {}
+        for mac, binding in static_config.get('dhcp', {}).get('binding', {}).iteritems():
+            try:
+                client_mac = mac.replace(':', '').replace('-', '').decode('hex')
+                if len(client_mac) != 6:
+                    raise ValueError('not 6 bytes long')
+                ip = str(binding.get('ipaddr', ''))
+                if ip:
+                    socket.inet_aton(ip)
+                options = self.encode_options(binding.get('subnet', self.subnet_mask),
+                                              binding.get('router', self.router),
+                                              binding.get('dns', [self.dns_server]))
+            except (AttributeError, TypeError, ValueError, socket.error) as e:
+                self.logger.warning('Ignoring static binding for {0}: {1}'.format(mac, e))
+                continue
+            bindings[client_mac] = (ip, options)
+        return bindings, self.encode_options(self.subnet_mask, self.router, [self.dns_server])
 
-        # if we use ints, we don't have to deal with octet overflow
-        # or nested loops (up to 3 with 10/8); convert both to 32-bit integers
+    def compile_boot_rules(self, static_config):
+        '''
+            Compiles the dhcp.boot section of a static configuration into
+            BootRules, with the next server and options 66 and 67 of each
+            rule encoded.
+        '''
+        rules = []
+        for rule in static_config.get('dhcp', {}).get('boot', []):
+            try:
+                archs = rule.get('arch')
+                if archs is not None:
+                    archs = frozenset(struct.pack('!H', arch) for arch in (archs if isinstance(archs, list) else [archs]))
+                vendor_class = rule.get('vendor_class')
+                vendor_class = str(vendor_class) if vendor_class is not None else None
+                user_class = rule.get('user_class')
+                user_class = str(user_class) if user_class is not None else None
+                # TFTP Server OR HTTP Server; if iPXE, need both
+                next_server = str(rule.get('next_server', self.file_server))
+                siaddr = socket.inet_aton(next_server)
+                server_option = self.tlv_encode(66, next_server)
+                filename = str(rule.get('filename', rule.get('script', '')))
+                if not filename:
+                    raise ValueError('neither filename nor script given')
+                boot = (siaddr, server_option + self.tlv_encode(67, filename + chr(0)))
+                script = rule.get('script')
+                ipxe_boot = (siaddr, server_option + self.tlv_encode(67, str(script) + chr(0))) if script else boot
+            except (AttributeError, TypeError, ValueError, struct.error, socket.error) as e:
+                self.logger.warning('Ignoring boot rule {0}: {1}'.format(rule, e))
+                continue
+            rules.append((archs, vendor_class, user_class, boot, ipxe_boot))
+        return BootRules(rules)
 
-        # e.g '192.168.1.1' to 3232235777
-        encode = lambda x: struct.unpack('!I', socket.inet_aton(x))[0]
+    def stat_static_config(self):
+        '''Returns what tells versions of the static configuration file apart, None if it is missing.'''
+        try:
+            stat = os.stat(self.static_config_file)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime)
 
-        # e.g 3232235777 to '192.168.1.1'
-        decode = lambda x: socket.inet_ntoa(struct.pack('!I', x))
+    def read_static_config(self, decoder = json.JSONDecoder()):
+        with open(self.static_config_file, 'rb') as static_config:
+            static_config = decoder.decode(static_config.read())
+        if not isinstance(static_config, dict):
+            raise ValueError('not a JSON object')
+        return static_config
 
-        from_host = encode(self.offer_from)
-        to_host = encode(self.offer_to)
+    def watch_static_config(self):
+        '''
+            Polls the static configuration file and, when it changes,
+            compiles it in this thread so listen only has to swap it in.
+        '''
+        # the C scanner would hold the GIL, and so listen, for the whole file
+        decoder = json.JSONDecoder()
+        decoder.scan_once = json.scanner.py_make_scanner(decoder)
+        # the structures replaced are freed here rather than by listen
+        current = (self.static_config, self.bindings, self.pool.reserved, self.boot_rules)
+        while True:
+            sleep(self.static_config_poll)
+            signature = self.stat_static_config()
+            if signature is None or signature == self.static_signature:
+                continue
+            self.static_signature = signature
+            with paused_gc():
+                try:
+                    static_config = self.read_static_config(decoder)
+                    bindings = self.compile_static(static_config)[0]
+                    boot_rules = self.compile_boot_rules(static_config)
+                except (IOError, ValueError) as e:
+                    self.logger.error('Not reloading {0}: {1}'.format(self.static_config_file, e))
+                    continue
+                except Exception:
+                    # e.g. sections of the wrong type, the watcher has to live on
+                    self.logger.exception('Not reloading {0}'.format(self.static_config_file))
+                    continue
+                previous = current
+                reserved = set(encode_ip(ip) for ip, options in bindings.itervalues() if ip)
+                current = (static_config, bindings, reserved, boot_rules)
+                # clients whose static address changed get a new lease
+                changed = [client_mac for client_mac in set(previous[1]) | set(bindings)
+                           if previous[1].get(client_mac, ('',))[0] != bindings.get(client_mac, ('',))[0]]
+                added = reserved - previous[2]
+            with self.reload_lock:
+                # listen has yet to swap in the previous reload; what it
+                # changed since the configuration served still has to be done
+                if self.reloaded:
+                    added = (added | self.reloaded[4]) & reserved
+                    changed = list(set(changed) | set(self.reloaded[5]))
+                self.reloaded = current + (added, changed)
+            self.logger.info('Reloaded {0}: {1} static bindings, {2} changed'.format(self.static_config_file, len(bindings), len(changed)))
 
-        # pull out already leased IPs
-        leased = [self.leases[i]['ip'] for i in self.leases
-                if self.leases[i]['expire'] > time()]
+    def swap_static_config(self):
+        '''This method swaps in the static configuration compiled by the watcher.'''
+        with self.reload_lock:
+            reloaded, self.reloaded = self.reloaded, None
+        if reloaded is None:
+            return
+        static_config, bindings, reserved, boot_rules, added, changed = reloaded
+        # addresses newly bound statically are taken back from their dynamic leases
+        for address in added:
+            for subnet in self.subnets:
+                if address in subnet.pool.owners:
+                    changed.append(subnet.pool.owners[address][0])
+        for client_mac in changed:
+            lease = self.leases.pop(client_mac, None)
+            if lease and lease.pool is not None:
+                lease.pool.release(lease.ip)
+            if lease and self.lease_store:
+                self.lease_store.record(client_mac, lease.ip, 0)
+        self.static_config = static_config
+        self.bindings = bindings
+        for subnet in self.subnets:
+            subnet.pool.set_reserved(reserved)
+        self.boot_rules = boot_rules
+        self.responses.clear()
 
-        # convert to 32-bit int
-        leased = map(encode, leased)
+    def get_namespaced_static(self, path, fallback = {}):
+        statics = self.static_config
+        for child in path.split('.'):
+            statics = statics.get(child, {})
+        return statics if statics else fallback
 
-        # loop through, make sure not already leased and not in form X.Y.Z.0
-        for offset in xrange(to_host - from_host):
-            if (from_host + offset) % 256 and from_host + offset not in leased:
-                return decode(from_host + offset)
-        raise OutOfLeasesError('Ran out of IP addresses to lease!')
+    def next_ip(self, client_mac = None, expire = None, pool = None):
+        '''
+            This method returns the next unleased IP from range, of the
+            first subnet unless given the pool of another; expired leases
+            are reclaimed by the pool.
+        '''
+        pool = self.pool if pool is None else pool
+        return pool.allocate(client_mac, expire if expire else time() + self.LEASE_TIME)
 
     def tlv_encode(self, tag, value):
         '''Encode a TLV option.'''
@@ -151,118 +807,228 @@ class AbstractDHCPD(object):
         '''
         return ':'.join(map(lambda x: hex(x)[2:].zfill(2), struct.unpack('BBBBBB', mac))).upper()
 
-    def craft_header(self, message):
-        '''This method crafts the DHCP header using parts of the message.'''
+    def assign(self, client_mac, now, expire, subnet = None):
+        '''This method leases a new client its static or the next free address of subnet.'''
+        # forget the leases whose addresses the pools take back
+        for pool in [s.pool for s in self.subnets]:
+            for owner in pool.reclaim(now):
+                if owner in self.leases and self.leases[owner].expire <= now:
+                    del self.leases[owner]
+        if len(self.leases) >= self.max_leases and client_mac not in self.leases:
+            raise OutOfLeasesError('Lease table is full ({0} leases)'.format(len(self.leases)))
+        ip = self.bindings[client_mac][0] if client_mac in self.bindings else ''
+        pool = None if ip else (self.subnet if subnet is None else subnet).pool
+        ip = ip if ip else self.next_ip(client_mac, expire, pool)
+        self.leases[client_mac] = Lease(ip, expire, pool)
+        self.logger.info('New Assignment - MAC: {0} -> IP: {1}'.format(self.get_mac(client_mac), ip))
+        return self.leases[client_mac]
+
+    def lease_for(self, client_mac, lease_time = LEASE_TIME, subnet = None):
+        '''This method returns the lease of a client on subnet, held for at least lease_time.'''
+        now = time()
+        lease = self.leases.get(client_mac)
+        if lease and lease.pool is not None and lease.pool is not (self.subnet if subnet is None else subnet).pool:
+            # the client moved to another subnet
+            lease.pool.release(lease.ip)
+            del self.leases[client_mac]
+            if self.lease_store:
+                self.lease_store.record(client_mac, lease.ip, 0)
+            lease = None
+        if lease and lease.expire > now:
+            if lease.expire < now + lease_time: # ACK after an OFFER, or a renewal
+                lease.expire = now + lease_time
+                if lease.pool is not None:
+                    lease.pool.renew(lease.ip, lease.expire)
+                if self.lease_store and lease_time > self.OFFER_TIME:
+                    self.lease_store.record(client_mac, lease.ip, lease.expire)
+        else: # new client, or an expired lease whose address may have been reclaimed
+            lease = self.assign(client_mac, now, now + lease_time, subnet)
+            if self.lease_store and lease_time > self.OFFER_TIME:
+                self.lease_store.record(client_mac, lease.ip, lease.expire)
+        return lease
+
+    def craft_header(self, message, lease_time = LEASE_TIME, subnet = None, siaddr = None):
+        '''
+            This method crafts the DHCP header using parts of the message,
+            leasing the client its address on subnet for at least lease_time
+            and naming siaddr, our own address by default, the next server.
+        '''
         xid, flags, yiaddr, giaddr, chaddr = struct.unpack('!4x4s2x2s4x4s4x4s16s', message[:44])
         client_mac = chaddr[:6]
+        offer = self.lease_for(client_mac, lease_time, subnet).ip
 
-        # op, htype, hlen, hops, xid
-        response =  struct.pack('!BBBB4s', 2, 1, 6, 0, xid)
-        response += struct.pack('!HHI', 0, 0, 0) # secs, flags, ciaddr
-        if self.leases[client_mac]['ip']: # OFFER
-            offer = self.leases[client_mac]['ip']
-        else: # ACK
-            offer = self.get_namespaced_static('dhcp.binding.{0}.ipaddr'.format(self.get_mac(client_mac)))
-            offer = offer if offer else self.next_ip()
-            self.leases[client_mac]['ip'] = offer
-            self.leases[client_mac]['expire'] = time() + 86400
-            self.logger.info('New Assignment - MAC: {0} -> IP: {1}'.format(self.get_mac(client_mac), self.leases[client_mac]['ip']))
-        response += socket.inet_aton(offer) # yiaddr
-        response += socket.inet_aton(self.file_server) # siaddr
-        response += socket.inet_aton('0.0.0.0') # giaddr
-        response += chaddr # chaddr
-
-        # BOOTP legacy pad
-        response += chr(0) * 64 # server name
-        response += chr(0) * 128
-        response += self.magic # magic section
+        # giaddr is kept so relay agents know which of their subnets to answer
+        response = REPLY_HEADER.pack(2, 1, 6, 0, xid, socket.inet_aton(offer), siaddr or self.siaddr, giaddr, chaddr, self.magic)
         return (client_mac, response)
 
-    def craft_options(self, opt53, client_mac):
+    def craft_options(self, opt53, client_mac, subnet = None):
         '''
             This method crafts the DHCP option fields
             opt53:
                 2 - DHCPOFFER
                 5 - DHCPACK
             See RFC2132 9.6 for details.
+            Returns the next server of the boot rule matching the client's
+            request, for the header, along with the options.
         '''
         response = self.tlv_encode(53, chr(opt53)) # message type, OFFER
-        response += self.tlv_encode(54, socket.inet_aton(self.ip)) # DHCP Server
-        subnet_mask = self.get_namespaced_static('dhcp.binding.{0}.subnet'.format(self.get_mac(client_mac)), self.subnet_mask)
-        response += self.tlv_encode(1, socket.inet_aton(subnet_mask)) # subnet mask
-        router = self.get_namespaced_static('dhcp.binding.{0}.router'.format(self.get_mac(client_mac)), self.router)
-        response += self.tlv_encode(3, socket.inet_aton(router)) # router
-        dns_server = self.get_namespaced_static('dhcp.binding.{0}.dns'.format(self.get_mac(client_mac)), [self.dns_server])
-        dns_server = ''.join([socket.inet_aton(i) for i in dns_server])
-        response += self.tlv_encode(6, dns_server)
-        response += self.tlv_encode(51, struct.pack('!I', 86400)) # lease time
-
-        # TFTP Server OR HTTP Server; if iPXE, need both
-        response += self.tlv_encode(66, self.file_server)
-        response += self.tlv_encode(67, self.filename(client_mac) + chr(0))
+        if client_mac in self.bindings:
+            response += self.bindings[client_mac][1]
+        else:
+            response += subnet.options if subnet else self.default_options
+        boot = self.boot_rules.match(self.client_options.get(client_mac, {})) if self.boot_rules else None
+        if boot:
+            siaddr = boot[0]
+            response += boot[1]
+        else:
+            siaddr = self.siaddr
+            response += self.file_server_option
+            response += self.tlv_encode(67, self.filename(client_mac) + chr(0))
         response += '\xff'
-        return response
+        return (siaddr, response)
 
     @abc.abstractmethod
     def filename(self, client_mac):
         '''Return the filename to use for the request.'''
         pass
 
-    def dhcp_offer(self, message):
-        '''This method responds to DHCP discovery with offer.'''
-        client_mac, header_response = self.craft_header(message)
-        options_response = self.craft_options(2, client_mac) # DHCPOFFER
+    def dhcp_offer(self, message, subnet = None):
+        '''This method returns the offer responding to DHCP discovery.'''
+        siaddr, options_response = self.craft_options(2, message[28:34], subnet) # DHCPOFFER
+        client_mac, header_response = self.craft_header(message, self.OFFER_TIME, subnet, siaddr)
         response = header_response + options_response
-        self.logger.debug('DHCPOFFER - Sending the following')
-        self.logger.debug('<--BEGIN HEADER-->')
-        self.logger.debug('{0}'.format(repr(header_response)))
-        self.logger.debug('<--END HEADER-->')
-        self.logger.debug('<--BEGIN OPTIONS-->')
-        self.logger.debug('{0}'.format(repr(options_response)))
-        self.logger.debug('<--END OPTIONS-->')
-        self.logger.debug('<--BEGIN RESPONSE-->')
-        self.logger.debug('{0}'.format(repr(response)))
-        self.logger.debug('<--END RESPONSE-->')
-        self.sock.sendto(response, (self.broadcast, 68))
-
-    def dhcp_ack(self, message):
-        '''This method responds to DHCP request with acknowledge.'''
-        client_mac, header_response = self.craft_header(message)
-        options_response = self.craft_options(5, client_mac) # DHCPACK
+        if self.logger.isEnabledFor(logging.DEBUG): # formatting packets is not free
+            self.logger.debug('DHCPOFFER - Sending the following')
+            self.logger.debug('<--BEGIN HEADER-->')
+            self.logger.debug('{0}'.format(repr(header_response)))
+            self.logger.debug('<--END HEADER-->')
+            self.logger.debug('<--BEGIN OPTIONS-->')
+            self.logger.debug('{0}'.format(repr(options_response)))
+            self.logger.debug('<--END OPTIONS-->')
+            self.logger.debug('<--BEGIN RESPONSE-->')
+            self.logger.debug('{0}'.format(repr(response)))
+            self.logger.debug('<--END RESPONSE-->')
+        return response
+
+    def dhcp_ack(self, message, subnet = None):
+        '''This method returns the acknowledge responding to DHCP request.'''
+        siaddr, options_response = self.craft_options(5, message[28:34], subnet) # DHCPACK
+        client_mac, header_response = self.craft_header(message, self.LEASE_TIME, subnet, siaddr)
         response = header_response + options_response
-        self.logger.debug('DHCPACK - Sending the following')
-        self.logger.debug('<--BEGIN HEADER-->')
-        self.logger.debug('{0}'.format(repr(header_response)))
-        self.logger.debug('<--END HEADER-->')
-        self.logger.debug('<--BEGIN OPTIONS-->')
-        self.logger.debug('{0}'.format(repr(options_response)))
-        self.logger.debug('<--END OPTIONS-->')
-        self.logger.debug('<--BEGIN RESPONSE-->')
-        self.logger.debug('{0}'.format(repr(response)))
-        self.logger.debug('<--END RESPONSE-->')
-        self.sock.sendto(response, (self.broadcast, 68))
+        if self.logger.isEnabledFor(logging.DEBUG): # formatting packets is not free
+            self.logger.debug('DHCPACK - Sending the following')
+            self.logger.debug('<--BEGIN HEADER-->')
+            self.logger.debug('{0}'.format(repr(header_response)))
+            self.logger.debug('<--END HEADER-->')
+            self.logger.debug('<--BEGIN OPTIONS-->')
+            self.logger.debug('{0}'.format(repr(options_response)))
+            self.logger.debug('<--END OPTIONS-->')
+            self.logger.debug('<--BEGIN RESPONSE-->')
+            self.logger.debug('{0}'.format(repr(response)))
+            self.logger.debug('<--END RESPONSE-->')
+        return response
 
-    def listen(self):
-        '''Main listen loop.'''
-        while True:
-            message, address = self.sock.recvfrom(1024)
-            [client_mac] = struct.unpack('!28x6s', message[:34])
+    def admit(self, client_mac, now):
+        '''
+            Token bucket per client, so a client sending more than
+            client_rate_limit requests per second, in bursts of up to
+            client_burst, can't keep the others waiting.
+        '''
+        tokens, updated = self.client_buckets.get(client_mac, (self.client_burst, now), now)
+        tokens = min(self.client_burst, tokens + (now - updated) * self.client_rate_limit)
+        if tokens < 1:
+            return False
+        self.client_buckets.set(client_mac, (tokens - 1, now), now)
+        return True
+
+    def relayed_subnet(self, giaddr):
+        '''Returns the subnet whose network holds the relay agent address giaddr, or None.'''
+        [address] = struct.unpack('!I', giaddr)
+        for mask in self.masks:
+            subnet = self.networks.get((mask, address & mask))
+            if subnet:
+                return subnet
+        return None
+
+    def handle(self, sock, message, address):
+        '''Answers a message received on sock.'''
+        now = time()
+        if self.reloaded:
+            self.swap_static_config()
+        [client_mac] = struct.unpack('!28x6s', message[:34])
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        if self.whitelist and client_mac not in self.bindings:
+            if debug:
+                self.logger.debug('Ignoring {0}, not in the static configuration'.format(self.get_mac(client_mac)))
+            return
+        if self.client_rate_limit and not self.admit(client_mac, now):
+            if debug:
+                self.logger.debug('Ignoring {0}, over its rate limit'.format(self.get_mac(client_mac)))
+            return
+        # clients send the message type first, so retransmissions are
+        # usually recognised without parsing the options
+        options = None
+        if message[240:242] == '\x35\x01' and len(message) > 242:
+            type = ord(message[242])
+        else:
+            options = self.tlv_parse(message[240:])
+            type = ord(options[53][0]) # see RFC2131, page 10
+        key = (client_mac, message[4:8], type)
+        cached = self.responses.get(key, None, now)
+        if cached:
+            if debug:
+                self.logger.debug('Resending response to {0}, a retransmission'.format(self.get_mac(client_mac)))
+            response, sock, reply_to = cached
+            sock.sendto(response, reply_to)
+            return
+        # relay agents are answered on the server port, clients by broadcast
+        giaddr = message[24:28]
+        relayed = giaddr != '\0\0\0\0'
+        if relayed:
+            subnet = self.relayed_subnet(giaddr)
+            reply_to = (socket.inet_ntoa(giaddr), self.port)
+            if subnet is None:
+                if debug:
+                    self.logger.debug('Ignoring {0}, no subnet for relay {1}'.format(self.get_mac(client_mac), reply_to[0]))
+                return
+        else:
+            subnet = self.sockets[sock]
+            reply_to = (subnet.broadcast, 68)
+        if options is None:
+            options = self.tlv_parse(message[240:])
+        self.client_options.set(client_mac, options, now)
+        if debug:
             self.logger.debug('Received message')
             self.logger.debug('<--BEGIN MESSAGE-->')
             self.logger.debug('{0}'.format(repr(message)))
             self.logger.debug('<--END MESSAGE-->')
-            self.leases[client_mac]['options'] = self.tlv_parse(message[240:])
             self.logger.debug('Parsed received options')
             self.logger.debug('<--BEGIN OPTIONS-->')
-            self.logger.debug('{0}'.format(repr(self.leases[client_mac]['options'])))
+            self.logger.debug('{0}'.format(repr(options)))
             self.logger.debug('<--END OPTIONS-->')
-            type = ord(self.leases[client_mac]['options'][53][0]) # see RFC2131, page 10
+        response = None
+        try:
             if type == 1:
                 self.logger.info('Received DHCPOFFER')
-                try:
-                    self.dhcp_offer(message)
-                except OutOfLeasesError:
-                    self.logger.critical('Ran out of leases')
-            elif type == 3 and address[0] == '0.0.0.0':
+                response = self.dhcp_offer(message, subnet)
+            elif type == 3 and (relayed or address[0] == '0.0.0.0'):
                 self.logger.info('Received DHCPACK')
-                self.dhcp_ack(message)
+                response = self.dhcp_ack(message, subnet)
+        except OutOfLeasesError as e:
+            self.logger.critical('Ran out of leases: {0}'.format(e))
+        if response:
+            sock.sendto(response, reply_to)
+            self.responses.set(key, (response, sock, reply_to), now)
+
+    def listen(self):
+        '''Main listen loop, over the sockets of all interfaces served.'''
+        sockets = list(self.sockets)
+        while True:
+            try:
+                readable = select.select(sockets, [], [])[0] if len(sockets) > 1 else sockets
+                for sock in readable:
+                    message, address = sock.recvfrom(1024)
+                    self.handle(sock, message, address)
+            except:
+                # e.g. a malformed request, or the lease store's disk filling up
+                self.logger.exception('listen loop exception')
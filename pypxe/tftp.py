@@ -5,77 +5,818 @@ This file contains classes and functions that implement the PyPXE TFTP service
 '''
 
 import abc
+import io
+import re
 import socket
 import struct
 import os
+import errno
+import fcntl
 import select
 import time
-import logging
+import heapq
+import bisect
+import itertools
+import json
 import math
+import logging
+import threading
+import Queue
+from collections import OrderedDict, deque
+
+# opcode and block number prefixed to every DATA packet
+DATA_HEADER = struct.Struct('!HH')
+# largest blksize allowed by RFC2348, so a DATA packet fits an IPv4 datagram
+MAX_BLKSIZE = 65464
+# {{name}} in templates, which neither pxelinux nor iPXE syntax uses
+TEMPLATE_VARIABLE = re.compile(r'\{\{\s*([A-Za-z_][A-Za-z0-9_]*)\s*\}\}')
 
 class ParentSocket(socket.socket):
     '''Subclassed socket.socket to enable a link-back to the client object.'''
     parent = None
 
 
-class AbstractClient(object):
+def format_mac(mac):
+    '''Returns a MAC address in any notation as AA:BB:CC:DD:EE:FF, or None if it isn't one.'''
+    digits = re.sub('[^0-9a-fA-F]', '', mac).upper()
+    if len(digits) != 12:
+        return None
+    return ':'.join(digits[i:i + 2] for i in xrange(0, 12, 2))
+
+
+class Poller(object):
+    '''
+        Thin wrapper around epoll, falling back to poll where epoll is not
+        available, so the listen loop can sleep until a socket is readable
+        or the next timer is due.
+    '''
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.flags = select.EPOLLIN
+            self.milliseconds = False
+        else:
+            self.poller = select.poll()
+            self.flags = select.POLLIN
+            self.milliseconds = True
+
+    def register(self, fd):
+        self.poller.register(fd, self.flags)
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def poll(self, timeout = None):
+        '''
+            Returns the readable file descriptors, waiting at most timeout
+            seconds; None waits forever.
+        '''
+        if timeout is None:
+            timeout = -1
+        else:
+            # round up to whole milliseconds, as both truncate to them and
+            # would spin until the timer is due
+            timeout = math.ceil(timeout * 1000)
+            if not self.milliseconds:
+                # epoll takes seconds, half a millisecond more survives rounding
+                timeout = (timeout + 0.5) / 1000
+        return [fd for fd, _ in self.poller.poll(timeout)]
+
+
+class WorkerPool(object):
+    '''
+        Threads running blocking backend calls off the listen loop. Results
+        are handed back through a pipe the loop polls, so callbacks always
+        run on the loop thread.
+    '''
+    def __init__(self, threads, logger):
+        self.logger = logger
+        self.requests = Queue.Queue()
+        self.results = deque()
+        self.rfd, self.wfd = os.pipe()
+        fcntl.fcntl(self.rfd, fcntl.F_SETFL, os.O_NONBLOCK)
+        for _ in xrange(threads):
+            worker = threading.Thread(target = self.work)
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, callback, function, *args):
+        '''Runs function(*args) on a worker, then callback(result) on the loop.'''
+        self.requests.put((callback, function, args))
+
+    def work(self):
+        while True:
+            callback, function, args = self.requests.get()
+            try:
+                result = function(*args)
+            except:
+                self.logger.exception('worker exception')
+                result = None
+            self.results.append((callback, result))
+            os.write(self.wfd, chr(0))
+
+    def drain(self):
+        '''Runs the callbacks of finished calls, called when rfd is readable.'''
+        try:
+            os.read(self.rfd, 4096)
+        except OSError:
+            pass
+        while self.results:
+            callback, result = self.results.popleft()
+            # the pipe is already emptied, so a failing callback must not
+            # leave the results behind it waiting for another wakeup
+            try:
+                callback(result)
+            except:
+                self.logger.exception('callback exception')
+
+
+class BlockCache(object):
+    '''
+        Shared, size-bounded LRU cache of file contents for TFTP clients.
+        Small files are held whole, larger ones in chunk_size pieces; chunks
+        are keyed by (filename, mtime, size) so a changed file is never served
+        from stale data.
+    '''
+    def __init__(self, max_size = 64 * 1024 * 1024, chunk_size = 1024 * 1024):
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.size = 0
+        self.chunks = OrderedDict()
+        # key is (filename, mtime, size), value is set of cached chunk indexes
+        self.indexes = {}
+        # key is filename, value is the current (filename, mtime, size)
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # backends may prepare requests on worker threads
+        self.lock = threading.Lock()
+
+    def validate(self, filename, fh):
+        '''
+            Returns the cache key for an open file, dropping chunks of an
+            older version of the same file.
+        '''
+        stat = os.fstat(fh.fileno())
+        key = (filename, stat.st_mtime, stat.st_size)
+        with self.lock:
+            old = self.versions.get(filename)
+            if old != key:
+                if old is not None:
+                    self.invalidate(old)
+                self.versions[filename] = key
+        return key
+
+    def invalidate(self, key):
+        '''Drops all cached chunks for the given key.'''
+        for index in self.indexes.pop(key, ()):
+            self.size -= len(self.chunks.pop((key, index)))
+
+    def evict(self):
+        '''Drops the least recently used chunk.'''
+        (key, index), chunk = self.chunks.popitem(last = False)
+        self.size -= len(chunk)
+        self.indexes[key].discard(index)
+        if not self.indexes[key]:
+            del self.indexes[key]
+        self.evictions += 1
+
+    def chunk(self, key, fh, index):
+        '''Returns chunk number index of the file, reading it on a miss.'''
+        with self.lock:
+            return self.locked_chunk(key, fh, index)
+
+    def locked_chunk(self, key, fh, index):
+        try:
+            chunk = self.chunks.pop((key, index))
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            fh.seek(index * self.chunk_size)
+            chunk = fh.read(self.chunk_size)
+            if len(chunk) > self.max_size:
+                return chunk
+            while self.chunks and self.size + len(chunk) > self.max_size:
+                self.evict()
+            self.size += len(chunk)
+            self.indexes.setdefault(key, set()).add(index)
+        # (re)insert at the most recently used end
+        self.chunks[(key, index)] = chunk
+        return chunk
+
+    def read(self, key, fh, offset, length):
+        '''Reads length bytes at offset, possibly spanning several chunks.'''
+        data = ''
+        while length > 0:
+            index, start = divmod(offset, self.chunk_size)
+            piece = self.chunk(key, fh, index)[start:start + length]
+            if not piece:
+                break
+            data += piece
+            offset += len(piece)
+            length -= len(piece)
+        return data
+
+    def read_into(self, key, fh, offset, view):
+        '''
+            Like read, but copies straight into a writable buffer and returns
+            the number of bytes copied.
+        '''
+        length = len(view)
+        filled = 0
+        while filled < length:
+            index, start = divmod(offset + filled, self.chunk_size)
+            piece = memoryview(self.chunk(key, fh, index))[start:start + length - filled]
+            if not len(piece):
+                break
+            view[filled:filled + len(piece)] = piece
+            filled += len(piece)
+        return filled
+
+    def stats(self):
+        '''Returns the cache counters, useful for sizing the cache.'''
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': self.size,
+                'chunks': len(self.chunks)}
+
+
+class Template(object):
+    '''A template compiled into alternating literal text and variable names.'''
+    def __init__(self, text):
+        self.parts = TEMPLATE_VARIABLE.split(text)
+        self.names = sorted(set(self.parts[1::2]))
+
+    def render(self, variables):
+        '''
+            Returns the template with every {{name}} replaced, raises
+            KeyError if a variable has no value.
+        '''
+        parts = list(self.parts)
+        parts[1::2] = [str(variables[name]) for name in parts[1::2]]
+        return ''.join(parts)
+
+
+class TemplateCache(object):
+    '''
+        Compiled templates and an LRU cache of their rendered output, so
+        thousands of clients with the same variables are rendered once.
+        Templates are stat()ed on every render and recompiled when their
+        mtime or size changes, which also invalidates their output.
+    '''
+    def __init__(self, max_renders = 4096):
+        self.max_renders = max_renders
+        # key is path, value is ((mtime, size), Template)
+        self.templates = {}
+        # key is (path, mtime, size, variables)
+        self.renders = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.compiles = 0
+
+    def template(self, path):
+        '''Returns the (mtime, size) and compiled template of a path.'''
+        stat = os.stat(path)
+        version = (stat.st_mtime, stat.st_size)
+        cached = self.templates.get(path)
+        if cached is None or cached[0] != version:
+            with open(path, 'rb') as f:
+                cached = (version, Template(f.read()))
+            self.templates[path] = cached
+            self.compiles += 1
+        return cached
+
+    def render(self, path, variables):
+        '''Returns the template at path rendered with variables, see Template.render.'''
+        version, template = self.template(path)
+        # only the variables used matter, so e.g. a file without {{ip}} is shared
+        key = (path, version, tuple(variables.get(name) for name in template.names))
+        data = self.renders.pop(key, None)
+        if data is None:
+            self.misses += 1
+            data = template.render(variables)
+            if len(self.renders) >= self.max_renders:
+                self.renders.popitem(last = False)
+        else:
+            self.hits += 1
+        self.renders[key] = data
+        return data
+
+    def stats(self):
+        '''Returns the cache counters.'''
+        return {'hits': self.hits, 'misses': self.misses,
+                'compiles': self.compiles, 'renders': len(self.renders)}
+
+
+class Histogram(object):
+    '''Counts of observations at or below each bound, as Prometheus does.'''
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels = ''):
+        '''Returns the histogram in the Prometheus text format.'''
+        lines = []
+        total = 0
+        for bound, count in zip(list(self.bounds) + ['+Inf'], self.counts):
+            total += count
+            lines.append('{0}_bucket{{{1}le="{2}"}} {3}'.format(name, labels, bound, total))
+        labels = '{{{0}}}'.format(labels.rstrip(',')) if labels else ''
+        lines.append('{0}_sum{1} {2}'.format(name, labels, self.sum))
+        lines.append('{0}_count{1} {2}'.format(name, labels, self.count))
+        return lines
+
+
+class TFTPStats(object):
+    '''
+        Counters kept by the TFTP server. Updating them is a few attribute
+        increments per packet, so they are always on.
+    '''
+    # upper bounds in seconds of the transfer time histogram buckets
+    TRANSFER_SECONDS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+    # files beyond this many get a shared histogram
+    MAX_FILES = 256
+    COUNTERS = ('transfers', 'completed', 'failed', 'blocks_sent', 'bytes_sent',
+                'retransmits', 'timeouts', 'duplicate_acks', 'out_of_order_acks')
+
+    def __init__(self):
+        self.transfers = 0
+        self.completed = 0
+        self.failed = 0
+        self.blocks_sent = 0
+        self.bytes_sent = 0
+        self.retransmits = 0
+        self.timeouts = 0
+        self.duplicate_acks = 0
+        self.out_of_order_acks = 0
+        # key is filename
+        self.transfer_seconds = {}
+        self.last_render = (time.time(), 0)
+
+    def finished(self, client):
+        '''Records a successfully completed transfer.'''
+        self.completed += 1
+        filename = client.filename
+        if filename not in self.transfer_seconds and len(self.transfer_seconds) >= self.MAX_FILES:
+            filename = ''
+        if filename not in self.transfer_seconds:
+            self.transfer_seconds[filename] = Histogram(self.TRANSFER_SECONDS)
+        self.transfer_seconds[filename].observe(time.time() - client.start_time)
+
+    def snapshot(self, server):
+        '''
+            Returns the counters and the state of the server as a dict of
+            plain values, so worker processes can report them to the
+            supervisor.
+        '''
+        snapshot = dict((name, getattr(self, name)) for name in self.COUNTERS)
+        snapshot['active_transfers'] = len(server.ongoing)
+        snapshot['multicast_sessions'] = len(server.multicast)
+        snapshot['cache'] = server.cache.stats() if server.cache is not None else {}
+        snapshot['transfer_seconds'] = dict(
+            (filename, [histogram.counts, histogram.sum, histogram.count])
+            for filename, histogram in self.transfer_seconds.items())
+        return snapshot
+
+    @classmethod
+    def counters(cls, snapshot):
+        '''Returns a snapshot without the state of its process, e.g. of a worker that died.'''
+        counters = dict(snapshot, active_transfers = 0, multicast_sessions = 0)
+        counters['cache'] = dict((name, value) for name, value in snapshot['cache'].items() if name not in ('size', 'chunks'))
+        return counters
+
+    @classmethod
+    def combine(cls, snapshots):
+        '''Adds up the snapshots of several worker processes.'''
+        total = dict((name, 0) for name in cls.COUNTERS)
+        total.update(active_transfers = 0, multicast_sessions = 0, cache = {}, transfer_seconds = {})
+        for snapshot in snapshots:
+            for name in cls.COUNTERS + ('active_transfers', 'multicast_sessions'):
+                total[name] += snapshot[name]
+            for name, value in snapshot['cache'].items():
+                total['cache'][name] = total['cache'].get(name, 0) + value
+            for filename, (counts, seconds, count) in snapshot['transfer_seconds'].items():
+                if filename not in total['transfer_seconds']:
+                    total['transfer_seconds'][filename] = [[0] * len(counts), 0, 0]
+                histogram = total['transfer_seconds'][filename]
+                histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+                histogram[1] += seconds
+                histogram[2] += count
+        return total
+
+    def render(self, snapshot):
+        '''Returns a snapshot in the Prometheus text format.'''
+        now = time.time()
+        last_time, last_bytes = self.last_render
+        self.last_render = (now, snapshot['bytes_sent'])
+        lines = [
+            'tftp_active_transfers {0}'.format(snapshot['active_transfers']),
+            'tftp_multicast_sessions {0}'.format(snapshot['multicast_sessions']),
+            'tftp_transfers_total {0}'.format(snapshot['transfers']),
+            'tftp_transfers_completed_total {0}'.format(snapshot['completed']),
+            'tftp_transfers_failed_total {0}'.format(snapshot['failed']),
+            'tftp_blocks_sent_total {0}'.format(snapshot['blocks_sent']),
+            'tftp_bytes_sent_total {0}'.format(snapshot['bytes_sent']),
+            'tftp_retransmits_total {0}'.format(snapshot['retransmits']),
+            'tftp_timeouts_total {0}'.format(snapshot['timeouts']),
+            'tftp_duplicate_acks_total {0}'.format(snapshot['duplicate_acks']),
+            'tftp_out_of_order_acks_total {0}'.format(snapshot['out_of_order_acks']),
+            # averaged since the previous time the stats were read
+            'tftp_bytes_per_second {0:.0f}'.format((snapshot['bytes_sent'] - last_bytes) / max(now - last_time, 1e-6)),
+        ]
+        if 'workers' in snapshot:
+            lines.append('tftp_workers {0}'.format(snapshot['workers']))
+            lines.append('tftp_worker_restarts_total {0}'.format(snapshot['worker_restarts']))
+        for name, value in sorted(snapshot['cache'].items()):
+            lines.append('tftp_cache_{0} {1}'.format(name, value))
+        for filename, (counts, seconds, count) in sorted(snapshot['transfer_seconds'].items()):
+            histogram = Histogram(self.TRANSFER_SECONDS)
+            histogram.counts, histogram.sum, histogram.count = counts, seconds, count
+            lines += histogram.render('tftp_transfer_seconds', 'file="{0}",'.format(filename.replace('"', '\\"')))
+        return '\n'.join(lines) + '\n'
+
+
+class RTTEstimator(object):
+    '''
+        Retransmission timeout estimated from observed ACK latency as in
+        RFC6298, with exponential backoff after a timeout. Callers must only
+        sample blocks that were not retransmitted (Karn's algorithm).
+    '''
+    def __init__(self, initial, minimum, maximum):
+        self.timeout = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.srtt = None
+        self.rttvar = None
+
+    def sample(self, rtt):
+        '''Updates the timeout with a new round-trip time measurement.'''
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.timeout = max(self.minimum, min(self.maximum, self.srtt + 4 * self.rttvar))
+
+    def backoff(self):
+        '''Doubles the timeout after it expired.'''
+        self.timeout = min(self.maximum, self.timeout * 2)
+
+
+class Pacer(object):
+    '''
+        Token bucket limiting a send rate in bytes per second, allowing
+        bursts of up to burst bytes. A full bucket always lets a packet
+        through, even one larger than burst.
+    '''
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready(self, size, now):
+        '''Determines if a packet of size bytes may be sent now.'''
+        self.refill(now)
+        return self.tokens >= min(size, self.burst)
+
+    def take(self, size):
+        '''Spends the tokens of a packet that was allowed by ready.'''
+        self.tokens -= size
+
+    def delay(self, size, now):
+        '''Returns the number of seconds until a packet of size bytes is ready.'''
+        self.refill(now)
+        return max(0, (min(size, self.burst) - self.tokens) / self.rate)
+
+
+class TransferOptions(object):
+    '''
+        Option negotiation and ACK handling of a read request, shared by
+        the TFTP engines. Expects the request in message, and the
+        filesize, blksize, window, rtt, parent and logger attributes of a
+        client; ACKs also need its window state (acked, block, sample,
+        prefetched and retries), stats, and send_window and complete.
+    '''
+    def parse_options(self):
+        '''
+            Extracts the options sent from a client; if any, calculates the last
+            block based on the filesize and blocksize.
+        '''
+        options = self.message.split(chr(0))[2: -1]
+        options = dict(zip([o.lower() for o in options[0::2]], options[1::2]))
+        for name in ('blksize', 'tsize', 'timeout', 'windowsize', 'rollover'):
+            try:
+                if name in options:
+                    options[name] = int(options[name])
+            except ValueError:
+                del options[name]
+        if options.get('blksize', 8) < 8:
+            del options['blksize']
+        self.blksize = min(options.get('blksize', self.blksize), MAX_BLKSIZE)
+        # the last block is always short, even if that means empty
+        self.lastblock = self.filesize // self.blksize + 1
+        self.tsize = True if 'tsize' in options else False
+        if 'windowsize' in options:
+            self.window = max(1, min(options['windowsize'], self.parent.max_window))
+        if 1 <= options.get('timeout', 0) <= 255:
+            # the client asked for a fixed timeout, see RFC2349
+            self.rtt = RTTEstimator(options['timeout'], options['timeout'], options['timeout'])
+        else:
+            options.pop('timeout', None)
+        if options.get('rollover') not in (0, 1):
+            options.pop('rollover', None)
+        # the block number after 65535, for files of more than 65535 blocks
+        self.rollover = options.get('rollover', self.parent.block_rollover)
+        self.options = options
+
+        if len(options):
+            # we need to know later if we actually had any options,
+            # the OACK is acknowledged with block 0
+            self.acked = -1
+            return True
+        else:
+            return False
+
+    def oack(self):
+        '''Returns the OACK packet for the options received.'''
+        # only called if options, so send them all
+        response = struct.pack("!H", 6)
+
+        response += 'blksize' + chr(0)
+        response += str(self.blksize) + chr(0)
+        response += 'tsize' + chr(0)
+        response += str(self.filesize) + chr(0)
+        if 'windowsize' in self.options:
+            response += 'windowsize' + chr(0)
+            response += str(self.window) + chr(0)
+        if 'timeout' in self.options:
+            response += 'timeout' + chr(0)
+            response += str(self.options['timeout']) + chr(0)
+        if 'rollover' in self.options:
+            response += 'rollover' + chr(0)
+            response += str(self.rollover) + chr(0)
+        return response
+
+    def wire_block(self, block):
+        '''Returns the 16 bit block number sent for an (absolute) block number.'''
+        if self.rollover and block > 0:
+            # 65535 is followed by 1, 0 only ever acknowledges the OACK
+            return (block - 1) % 65535 + 1
+        return block % 65536
+
+    def ack_delta(self, block):
+        '''
+            Returns how many blocks the 16 bit block number of an ACK is
+            ahead of the last ACK; duplicates are 0 or more than half the
+            block number space ahead.
+        '''
+        if not self.rollover or self.acked <= 0:
+            return (block - self.acked) % 65536
+        return (block - self.wire_block(self.acked)) % 65535
+
+    def handle_ack(self, block):
+        '''
+            Acts on an ACK of the 16 bit block number: completes the
+            transfer after the last block, otherwise moves the window on
+            past the block acknowledged and sends what follows.
+        '''
+        # block numbers are absolute, only the wire block number wraps
+        delta = self.ack_delta(block)
+        acked = self.acked + delta
+        if delta == 0 or delta > 32768:
+            self.stats.duplicate_acks += 1
+            self.logger.warning('Ignoring duplicated ACK received for block {0}'.format(acked))
+        elif acked >= self.block:
+            self.stats.out_of_order_acks += 1
+            self.logger.warning('Ignoring out of sequence ACK received for block {0}'.format(acked))
+        elif acked == self.lastblock:
+            elapsed = time.time() - self.start_time
+            self.logger.info('Completed sending "{0}" in {1:.2f}s ({2:.0f} bytes/s)'.format(self.filename, elapsed, self.filesize / max(elapsed, 1e-6)))
+            self.stats.finished(self)
+            self.complete()
+        else:
+            if self.sample is not None and acked >= self.sample[0]:
+                self.rtt.sample(time.time() - self.sample[1])
+                self.sample = None
+            # restart from the block after the ACK, if the client missed
+            # part of the window this resends the remainder
+            for done in xrange(max(self.acked, 0) + 1, acked + 1):
+                self.prefetched.pop(done, None)
+            self.acked = acked
+            self.block = acked + 1
+            self.retries = self.default_retries
+            self.ack_time = time.time()
+            self.send_window()
+
+
+class AbstractClient(TransferOptions):
     '''Client instance for TFTPD.'''
 
     __metaclass__ = abc.ABCMeta
 
+    # set by backends whose check_file and prepare_request, or next_block,
+    # may block (e.g. on the network); those calls then run on the server's
+    # worker threads, and blocks are read ahead of the window
+    blocking_open = False
+    blocking_read = False
+
     def __init__(self, mainsock, parent):
 
+        self.parent = parent
         self.default_retries = parent.default_retries
-        self.timeout = parent.timeout
+        self.rtt = RTTEstimator(parent.timeout, parent.min_timeout, parent.max_timeout)
         self.ip = parent.ip
+        self.stats = parent.stats
+        self.start_time = time.time()
         self.message, self.address = mainsock.recvfrom(1024)
         self.logger = parent.logger.getChild('Client.{0}'.format(self.address))
         self.logger.debug('Recieving request...')
         self.retries = self.default_retries
+        # time of the last valid ACK, retries are given up on by time too
+        self.ack_time = self.start_time
+        # highest block acknowledged by the client and the next block to send
+        self.acked = 0
         self.block = 1
+        # highest block ever sent, and the (block, time) being timed
+        self.sent = 0
+        self.sample = None
+        # blocks read ahead by blocking_read backends
+        self.prefetched = {}
+        self.fetching = False
         self.blksize = 512
+        self.window = 1
         self.sent_time = float('inf')
+        self.scheduled = False
         self.dead = False
-        self.wrap = 0
         self.filesize = 0
         self.filename = ''
+        # per transfer rate limit, and if we are queued for the server's
+        self.pacer = Pacer(parent.client_rate_limit, parent.rate_burst) if parent.client_rate_limit else None
+        self.paced = False
+        self.deficit = 0
 
     def ready(self):
         '''Called when there is something to be read on our socket.'''
-        self.message = self.sock.recv(1024)
+        try:
+            self.message = self.sock.recv(1024)
+        except socket.error:
+            # spurious wakeup, our socket is non-blocking
+            return
         self.handle()
 
     @abc.abstractmethod
-    def next_block(self):
-        '''Return the next block to send to the client.'''
+    def next_block(self, block):
+        '''Return the data of the given (absolute) block number.'''
         pass
 
-    def send_block(self):
+    def fill_block(self, block, view):
         '''
-            Sends the next block of data, setting the timeout and retry
-            variables accordingly.
+            Copies the data of the given block into view and returns its
+            length, or None if there is no data. Backends that can read
+            straight into memory should override this.
         '''
-        block = self.next_block()
-        if block is None:
+        if self.blocking_read:
+            data = self.prefetched.get(block)
+        else:
+            data = self.next_block(block)
+        if data is None:
+            return None
+        view[:len(data)] = data
+        return len(data)
+
+    def allocate_buffer(self):
+        '''
+            Allocates the buffer DATA packets are assembled in, once the
+            block size is known, so sending a block doesn't allocate.
+        '''
+        self.buffer = bytearray(DATA_HEADER.size + self.blksize)
+        self.packet = memoryview(self.buffer)
+        self.payload = self.packet[DATA_HEADER.size:]
+
+    def send_block(self, block):
+        '''Sends a single block of data, setting the timeout accordingly.'''
+        length = self.fill_block(block, self.payload)
+        if length is None:
           self.logger.debug('Got empty block, ignoring')
           return
         # opcode 3 == DATA, wraparound block number
-        response = struct.pack('!HH', 3, self.block % 65536)
-        response += block
-        self.sock.sendto(response, self.address)
-        self.logger.debug('Sending block {0}'.format(self.block))
-        self.retries -= 1
+        DATA_HEADER.pack_into(self.buffer, 0, 3, self.wire_block(block))
+        self.sock.sendto(self.packet[:DATA_HEADER.size + length], self.address)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Sending block {0}'.format(block))
+        self.stats.blocks_sent += 1
+        self.stats.bytes_sent += length
+        if block <= self.sent:
+            self.stats.retransmits += 1
         self.sent_time = time.time()
+        self.parent.schedule(self)
+
+    def send_window(self):
+        '''
+            Sends every block of the current window that has not been sent
+            yet; see RFC7440. With a window of 1 this is plain lock-step.
+        '''
+        last = min(self.acked + self.window, self.lastblock)
+        while self.block <= last:
+            if self.blocking_read and self.block not in self.prefetched:
+                # carry on once the block has been read
+                self.read_ahead()
+                return
+            if not self.parent.pace(self):
+                # the server calls us again once it is our turn
+                break
+            self.send_block(self.block)
+            if self.block > self.sent:
+                # only time blocks sent once, see Karn's algorithm
+                if self.sample is None:
+                    self.sample = (self.block, self.sent_time)
+                self.sent = self.block
+            self.block += 1
+        if self.blocking_read:
+            self.read_ahead()
+
+    def read_ahead(self):
+        '''
+            Reads the next blocks that have not been read yet on a worker
+            thread, so DATA packets don't wait on the backend.
+        '''
+        if self.fetching:
+            return
+        last = min(self.block + self.parent.readahead, self.lastblock + 1)
+        blocks = [block for block in xrange(self.block, last) if block not in self.prefetched]
+        if blocks:
+            self.fetching = True
+            self.parent.pool.submit(self.blocks_read, self.read_blocks, blocks)
+
+    def read_blocks(self, blocks):
+        '''Returns the data of the given blocks, run on a worker thread.'''
+        return [(block, self.next_block(block)) for block in blocks]
+
+    def blocks_read(self, blocks):
+        '''Called on the loop once read_blocks is done.'''
+        self.fetching = False
+        if self.dead:
+            return
+        if blocks is None:
+            self.send_error(0, 'Read error', filename = self.filename)
+            self.complete()
+            return
+        self.prefetched.update(blocks)
+        self.send_window()
+
+    def retransmit(self):
+        '''
+            Called when we timed out waiting for an ACK; resends the window
+            starting from the last acknowledged block.
+        '''
+        self.retries -= 1
+        self.stats.timeouts += 1
+        if self.no_retries():
+            self.logger.warning('Timed out sending "{0}"'.format(self.filename))
+            self.stats.failed += 1
+            self.complete()
+            return
+        self.rtt.backoff()
+        self.sample = None
+        if self.acked < 0:
+            # the OACK or its ACK was lost
+            self.sock.sendto(self.oack(), self.address)
+            self.sent_time = time.time()
+            self.parent.schedule(self)
+            return
+        self.block = self.acked + 1
+        self.send_window()
+
+    def deadline(self):
+        '''Returns the time at which we give up waiting for an ACK.'''
+        return self.sent_time + self.rtt.timeout
 
     def no_ack(self):
         '''Determines if we timed out waiting for an ACK from the client.'''
-        if self.sent_time + self.timeout < time.time():
+        if self.deadline() <= time.time():
             return True
         return False
 
     def no_retries(self):
-        '''Determines if the client ran out of retry attempts.'''
-        if not self.retries:
+        '''
+            Determines if the client ran out of retry attempts, and of the
+            timeout seconds per retry since its last ACK; the estimated
+            timeout is often much shorter than the configured one.
+        '''
+        if self.retries <= 0 and time.time() - self.ack_time >= self.parent.timeout * self.default_retries:
             return True
         return False
 
@@ -103,38 +844,25 @@ class AbstractClient(object):
         self.send_error(1, 'File Not Found', filename = filename)
         return False
 
-    def parse_options(self):
+    def open_request(self):
         '''
-            Extracts the options sent from a client; if any, calculates the last
-            block based on the filesize and blocksize.
+            Validates the requested file and prepares the backend, returning
+            False if the request was refused. Runs on a worker thread for
+            blocking_open backends.
         '''
-        options = self.message.split(chr(0))[2: -1]
-        options = dict(zip(options[0::2], map(int, options[1::2])))
-        self.blksize = options.get('blksize', self.blksize)
-        self.lastblock = math.ceil(self.filesize / float(self.blksize))
-        self.tsize = True if 'tsize' in options else False
-        if self.filesize > (2 ** 16) * self.blksize:
-            self.logger.warning('Request too big, attempting transfer anyway.')
-            self.logger.debug('Details: Filesize {0} is too big for blksize {1}.'.format(self.filesize, self.blksize))
-
-        if len(options):
-            # we need to know later if we actually had any options
-            self.block = 0
-            return True
-        else:
+        if not self.validate_file():
             return False
+        self.logger.info('New request for "{0}"'.format(self.filename))
+        self.prepare_request(self.filename)
+        return True
 
     def reply_options(self):
         '''Acknowledges any options received.'''
-        # only called if options, so send them all
-        response = struct.pack("!H", 6)
-
-        response += 'blksize' + chr(0)
-        response += str(self.blksize) + chr(0)
-        response += 'tsize' + chr(0)
-        response += str(self.filesize) + chr(0)
-
-        self.sock.sendto(response, self.address)
+        self.sock.sendto(self.oack(), self.address)
+        # a resent OACK is not timed, so its ACK gives a valid first sample
+        self.sample = (0, time.time())
+        self.sent_time = self.sample[1]
+        self.parent.schedule(self)
 
 
     @abc.abstractmethod
@@ -152,22 +880,41 @@ class AbstractClient(object):
         self.sock = ParentSocket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind((self.ip, 0))
-        # used by select() to find ready clients
+        self.sock.setblocking(0)
         self.sock.parent = self
+        if self.parent.trace:
+            self.parent.trace.attach(self.sock)
+        self.parent.register(self)
+
+        if not self.valid_mode():
+            self.complete()
+            return
+        if self.blocking_open:
+            self.parent.pool.submit(self.start_transfer, self.open_request)
+        else:
+            self.start_transfer(self.open_request())
 
-        if not self.valid_mode() or not self.validate_file():
+    def start_transfer(self, opened):
+        '''
+            Once the request has been opened, negotiates the options and
+            sends either the OACK or the first block.
+        '''
+        if self.dead:
+            return
+        if not opened:
             # some clients just ACK the error (wrong code?)
             # so forcefully shutdown
             self.complete()
             return
 
-        self.logger.info('New request for "{0}"'.format(self.filename))
-        self.prepare_request(self.filename)
-
-        if not self.parse_options():
+        self.stats.transfers += 1
+        options = self.parse_options()
+        self.allocate_buffer()
+        if 'multicast' in self.options and self.parent.multicast_address and self.parent.join_multicast(self):
+            return
+        if not options:
             # no options recieved so start transfer
-            if self.block == 1:
-                self.send_block()
+            self.send_window()
             return
 
         # we got some options so ACK those first
@@ -201,6 +948,7 @@ class AbstractClient(object):
             Closes the socket after sending it
             and marks ourselves as dead to be cleaned up.
         '''
+        self.parent.unregister(self)
         self.sock.close()
         self.dead = True
 
@@ -213,22 +961,7 @@ class AbstractClient(object):
             self.new_request()
         elif opcode == 4:
             [block] = struct.unpack('!H', self.message[2:4])
-            if block == 0:
-                self.wrap += 1
-            if block < self.block % 65536:
-                self.logger.warning('Ignoring duplicated ACK received for block {0}'.format(self.block))
-            elif block > self.block % 65536:
-                self.logger.warning('Ignoring out of sequence ACK received for block {0}'.format(self.block))
-            elif block + self.wrap * 65536 == self.lastblock:
-                if self.filesize % self.blksize == 0:
-                    self.block = block + 1
-                    self.send_block()
-                self.logger.info('Completed sending "{0}"'.format(self.filename))
-                self.complete()
-            else:
-                self.block = block + 1
-                self.retries = self.default_retries
-                self.send_block()
+            self.handle_ack(block)
 
 
 class FileBackedClient(AbstractClient):
@@ -237,6 +970,7 @@ class FileBackedClient(AbstractClient):
     def __init__(self, mainsock, parent):
         super(FileBackedClient, self).__init__(mainsock, parent)
         self.fh = None
+        self.cache_key = None
 
     def check_file(self, filename):
         '''
@@ -254,23 +988,277 @@ class FileBackedClient(AbstractClient):
           return
         self.fh.close()
 
-    def next_block(self):
-        '''Return the next block to send to the client.'''
+    def next_block(self, block):
+        '''Return the data of the given (absolute) block number.'''
         if self.fh is None:
           return None
-        return self.fh.read(self.blksize)
+        offset = (block - 1) * self.blksize
+        if self.cache_key is None:
+            self.fh.seek(offset)
+            return self.fh.read(self.blksize)
+        return self.parent.cache.read(self.cache_key, self.fh, offset, self.blksize)
+
+    def fill_block(self, block, view):
+        '''Reads the given block straight into view.'''
+        if self.fh is None:
+          return None
+        offset = (block - 1) * self.blksize
+        if self.cache_key is None:
+            self.fh.seek(offset)
+            return self.fh.readinto(view[:self.blksize])
+        return self.parent.cache.read_into(self.cache_key, self.fh, offset, view[:self.blksize])
+
+    def local_path(self, filename):
+        '''Returns the path of the local file to serve for a request.'''
+        return filename
 
     def prepare_request(self, filename):
         '''Open file handler in preparation for serving the file.'''
-        self.fh = open(self.filename, 'rb')
-        self.filesize = os.path.getsize(self.filename)
+        path = self.local_path(filename)
+        self.fh = open(path, 'rb')
+        self.filesize = os.path.getsize(path)
+        if self.parent.cache is not None:
+            self.cache_key = self.parent.cache.validate(path, self.fh)
+
+
+class TemplateBackedClient(FileBackedClient):
+    '''
+        Client instance serving files rendered from templates for filenames
+        matching the server's template patterns, such as per-MAC pxelinux
+        configs, and local files otherwise.
+    '''
+    def __init__(self, mainsock, parent):
+        super(TemplateBackedClient, self).__init__(mainsock, parent)
+        # the rendered file, once a template matched
+        self.rendered = None
+
+    def check_file(self, filename):
+        '''
+            Matches the filename against the templates, then local files.
+            A template missing a variable for this client doesn't exist, so
+            e.g. pxelinux goes on to its next config file name.
+        '''
+        for pattern, path in self.parent.templates:
+            match = pattern.match(filename)
+            if not match:
+                continue
+            if not os.path.isfile(path):
+                return False
+            try:
+                self.rendered = self.parent.templates_cache.render(path, self.variables(filename, match.groupdict()))
+            except KeyError as e:
+                self.logger.debug('No {0} for template {1}'.format(e, path))
+                return False
+            return True
+        return super(TemplateBackedClient, self).check_file(filename)
+
+    def variables(self, filename, groups):
+        '''
+            Returns the template variables for this client: ip, mac,
+            filename and the named groups of the pattern, on top of the
+            client's static DHCP binding and the static tftp variables.
+        '''
+        mac = groups.get('mac') or self.parent.arp_lookup(self.address[0])
+        mac = format_mac(mac) if mac else None
+        if mac is None:
+            # e.g. behind a router, so try the static lease of the IP
+            mac = self.parent.bound_ips.get(self.address[0])
+        variables = dict(self.parent.static_config.get('tftp', {}).get('variables', {}))
+        binding = self.parent.bindings.get(mac, {})
+        for name, value in binding.items():
+            variables[name] = ','.join(value) if isinstance(value, list) else value
+        variables.update((name, value) for name, value in groups.items() if value is not None)
+        variables.update(ip = self.address[0], filename = filename)
+        if mac:
+            variables['mac'] = mac
+        return variables
+
+    def prepare_request(self, filename):
+        '''Opens the rendered template, or the local file, to be served.'''
+        if self.rendered is None:
+            super(TemplateBackedClient, self).prepare_request(filename)
+            return
+        # not a file, so not for the block cache
+        self.fh = io.BytesIO(self.rendered)
+        self.filesize = len(self.rendered)
+
+
+class MulticastSession(object):
+    '''
+        A multicast transfer of one file to any number of clients, see
+        RFC2090. Every block is sent once to the group address and only the
+        master client acknowledges; when it is done, leaves or times out,
+        the next client becomes master and acknowledges the blocks it
+        already has, so late joiners catch up on what they missed.
+    '''
+    def __init__(self, parent, source, group):
+        self.parent = parent
+        self.group = group
+        self.logger = parent.logger.getChild('Multicast.{0}'.format(group[0]))
+        self.sock = ParentSocket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, parent.multicast_ttl)
+        if parent.ip != '0.0.0.0':
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(parent.ip))
+        self.sock.bind((parent.ip, 0))
+        self.sock.setblocking(0)
+        self.sock.parent = self
+        if parent.trace:
+            parent.trace.attach(self.sock)
+        # the client that made the first request reads the file for us,
+        # and closes our socket with its own resources once we are done
+        self.source = source
+        source.sock = self.sock
+        self.filename = source.filename
+        # list of (address, OACK), the first being the master client
+        self.clients = []
+        self.rtt = RTTEstimator(parent.timeout, parent.min_timeout, parent.max_timeout)
+        self.default_retries = parent.default_retries
+        self.retries = self.default_retries
+        self.ack_time = time.time()
+        # highest block ever sent and the block the master should ACK,
+        # 0 while waiting for the master to ACK its OACK
+        self.sent = 0
+        self.block = 0
+        self.sample = None
+        self.sent_time = float('inf')
+        self.scheduled = False
+        self.dead = False
+        parent.register(self)
+
+    def join(self, client):
+        '''Adds a client to the session; the first to join is master.'''
+        self.logger.info('{0} joined multicast transfer of "{1}"'.format(client.address, self.filename))
+        self.clients.append((client.address, client.oack()))
+        if len(self.clients) == 1:
+            self.promote()
+        else:
+            self.send_oack(*self.clients[-1], master = False)
+
+    def leave(self, address):
+        '''Removes a client, promoting the next one if it was master.'''
+        master = self.clients and self.clients[0][0] == address
+        self.clients = [client for client in self.clients if client[0] != address]
+        if master:
+            self.promote()
+
+    def promote(self):
+        '''Makes the first client master, or ends the session if there is none.'''
+        if not self.clients:
+            self.logger.info('Completed multicast transfer of "{0}"'.format(self.filename))
+            self.complete()
+            return
+        self.retries = self.default_retries
+        self.ack_time = time.time()
+        self.block = 0
+        self.send_oack(*self.clients[0])
+
+    def send_oack(self, address, oack, master = True):
+        '''Sends the OACK telling a client the group and if it is master.'''
+        response = oack + 'multicast' + chr(0)
+        response += '{0},{1},{2}'.format(self.group[0], self.group[1], int(master)) + chr(0)
+        self.sock.sendto(response, address)
+        if master:
+            self.sent_time = time.time()
+            self.parent.schedule(self)
+
+    def send_block(self, block):
+        '''Sends a block to the group, setting the timeout accordingly.'''
+        length = self.source.fill_block(block, self.source.payload)
+        DATA_HEADER.pack_into(self.source.buffer, 0, 3, self.source.wire_block(block))
+        self.sock.sendto(self.source.packet[:DATA_HEADER.size + length], self.group)
+        self.parent.stats.blocks_sent += 1
+        self.parent.stats.bytes_sent += length
+        if block <= self.sent:
+            self.parent.stats.retransmits += 1
+        self.sent_time = time.time()
+        if block > self.sent:
+            # only time blocks sent once, see Karn's algorithm
+            if self.sample is None:
+                self.sample = (block, self.sent_time)
+            self.sent = block
+        self.block = block
+        self.parent.schedule(self)
+
+    def ready(self):
+        '''Called when there is something to be read on our socket.'''
+        try:
+            message, address = self.sock.recvfrom(1024)
+        except socket.error:
+            return
+        [opcode] = struct.unpack('!H', message[:2])
+        if opcode == 5:
+            self.leave(address)
+            return
+        if opcode != 4 or not self.clients or self.clients[0][0] != address:
+            # only the master client acknowledges
+            return
+        [block] = struct.unpack('!H', message[2:4])
+        # the latest block we sent with that wire block number
+        period = 65535 if self.source.rollover and block else 65536
+        acked = self.sent - ((self.source.wire_block(self.sent) - block) % period)
+        if acked < self.block:
+            # ignore duplicates, a master may skip ahead to blocks it has
+            return
+        if self.sample is not None and acked >= self.sample[0]:
+            self.rtt.sample(time.time() - self.sample[1])
+            self.sample = None
+        self.retries = self.default_retries
+        self.ack_time = time.time()
+        if acked >= self.source.lastblock:
+            self.logger.info('Master client {0} completed "{1}"'.format(address, self.filename))
+            self.parent.stats.finished(self.source)
+            self.clients.pop(0)
+            self.promote()
+            return
+        self.send_block(acked + 1)
+
+    def retransmit(self):
+        '''
+            Called when the master client timed out; resends what it is
+            waiting for, or gives up on it and promotes the next client.
+        '''
+        self.retries -= 1
+        self.parent.stats.timeouts += 1
+        if self.retries <= 0 and time.time() - self.ack_time >= self.parent.timeout * self.default_retries:
+            self.logger.warning('Master client {0} timed out'.format(self.clients[0][0]))
+            self.parent.stats.failed += 1
+            self.clients.pop(0)
+            self.promote()
+            return
+        self.rtt.backoff()
+        self.sample = None
+        if self.block:
+            self.send_block(self.block)
+        else:
+            self.send_oack(*self.clients[0])
+
+    def deadline(self):
+        '''Returns the time at which we give up waiting for an ACK.'''
+        return self.sent_time + self.rtt.timeout
+
+    def no_ack(self):
+        '''Determines if we timed out waiting for an ACK from the master.'''
+        return self.deadline() <= time.time()
+
+    def complete(self):
+        '''Releases the group and closes the source client with our socket.'''
+        self.parent.unregister(self)
+        self.parent.end_multicast(self)
+        self.source.complete()
+        self.dead = True
 
 
 class BaseTFTPD(object):
     '''
         This class implements a read-only TFTP server
-        implemented from RFC1350 and RFC2348
+        implemented from RFC1350, RFC2090, RFC2348, RFC2349 and RFC7440
     '''
+    # seconds between the stats snapshots workers send the supervisor
+    REPORT_INTERVAL = 1
+    # bytes a rate limited client may send per turn, about one packet
+    PACING_QUANTUM = 1500
+
     def __init__(self, client_cls, **server_settings):
         self.ip = server_settings.get('ip', '0.0.0.0')
         self.port = server_settings.get('port', 69)
@@ -278,9 +1266,28 @@ class BaseTFTPD(object):
         self.logger = server_settings.get('logger', None)
         self.default_retries = server_settings.get('default_retries', 3)
         self.timeout = server_settings.get('timeout', 5)
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind((self.ip, self.port))
+        self.min_timeout = server_settings.get('min_timeout', 0.5)
+        self.max_timeout = server_settings.get('max_timeout', 30)
+        self.max_window = server_settings.get('max_window', 16)
+        self.multicast_address = server_settings.get('multicast_address', None)
+        self.multicast_port = server_settings.get('multicast_port', 1758)
+        self.multicast_groups = server_settings.get('multicast_groups', 16)
+        self.multicast_ttl = server_settings.get('multicast_ttl', 1)
+        self.block_rollover = server_settings.get('block_rollover', 0)
+        self.rate_limit = server_settings.get('rate_limit', None)
+        self.client_rate_limit = server_settings.get('client_rate_limit', None)
+        self.rate_burst = server_settings.get('rate_burst', 65536)
+        self.threads = server_settings.get('threads', 4)
+        self.readahead = server_settings.get('readahead', 8)
+        self.stats_ip = server_settings.get('stats_ip', '127.0.0.1')
+        self.stats_port = server_settings.get('stats_port', None)
+        self.cache_size = server_settings.get('cache_size', 64 * 1024 * 1024)
+        self.cache_chunk_size = server_settings.get('cache_chunk_size', 1024 * 1024)
+        self.static_config = server_settings.get('static_config', dict())
+        self.template_cache_size = server_settings.get('template_cache_size', 4096)
+        self.workers = server_settings.get('workers', 1)
+        self.trace = server_settings.get('trace', None)
+        self.sock = self.bind()
         self.client_cls = client_cls
 
         # setup logger
@@ -297,30 +1304,454 @@ class BaseTFTPD(object):
         self.logger.debug('NOTICE: TFTP server started in debug mode. TFTP server is using the following:')
         self.logger.debug('Server IP: {0}'.format(self.ip))
         self.logger.debug('Server Port: {0}'.format(self.port))
+        self.logger.debug('Retransmit Timeout: {0}s initially, {1}s - {2}s'.format(self.timeout, self.min_timeout, self.max_timeout))
+        self.logger.debug('Maximum Window Size: {0}'.format(self.max_window))
+        self.logger.debug('Block Number Rollover: to {0}'.format(self.block_rollover))
+        if self.rate_limit or self.client_rate_limit:
+            self.logger.debug('Rate Limit: {0} bytes/s, {1} bytes/s per transfer, {2} byte bursts'.format(self.rate_limit, self.client_rate_limit, self.rate_burst))
+        if self.multicast_address:
+            self.logger.debug('Multicast Groups: {0} from {1}:{2}'.format(self.multicast_groups, self.multicast_address, self.multicast_port))
+        self.logger.debug('Worker Threads: {0}, reading ahead {1} blocks'.format(self.threads, self.readahead))
+        if self.stats_port:
+            self.logger.debug('Stats: {0}:{1}'.format(self.stats_ip, self.stats_port))
+        self.logger.debug('Block Cache: {0} bytes in {1} byte chunks'.format(self.cache_size, self.cache_chunk_size))
+        if self.workers > 1:
+            self.logger.debug('Worker Processes: {0}'.format(self.workers))
+
+        # list of (compiled filename pattern, template path)
+        self.templates = [(re.compile(pattern + '$'), path)
+                          for pattern, path in self.static_config.get('tftp', {}).get('templates', [])]
+        self.templates_cache = TemplateCache(self.template_cache_size)
+        self.arp = None
+        if self.templates and os.path.exists('/proc/net/arp'):
+            # opened now, as subclasses may chroot
+            self.arp = open('/proc/net/arp', 'rb')
+        if self.templates:
+            self.logger.debug('Templates: {0}, caching {1} rendered files'.format(len(self.templates), self.template_cache_size))
+
+        # static DHCP bindings for the templates, key is the MAC as
+        # format_mac gives it whatever its form in the configuration,
+        # and the MACs of the addresses bound, key is IP
+        self.bindings = {}
+        self.bound_ips = {}
+        for mac, binding in self.static_config.get('dhcp', {}).get('binding', {}).iteritems():
+            mac = format_mac(mac)
+            if mac is None:
+                continue
+            self.bindings[mac] = binding
+            if binding.get('ipaddr'):
+                self.bound_ips.setdefault(binding['ipaddr'], mac)
+
+        self.stats_sock = None
+        if self.stats_port:
+            self.stats_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.stats_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.stats_sock.bind((self.stats_ip, self.stats_port))
+            self.stats_sock.listen(4)
+            self.stats_sock.setblocking(0)
+        # write end of the pipe to the supervisor, in worker processes only
+        self.report_fd = None
+        self.next_report = 0
+        self.setup()
+
+    def bind(self):
+        '''Returns a new socket bound to the TFTP port.'''
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.workers > 1:
+            # every worker binds the port, the kernel spreads requests over them
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.ip, self.port))
+        if self.trace:
+            self.trace.attach(sock)
+        return sock
+
+    def setup(self):
+        '''
+            Creates the state of the listen loop. Worker processes call
+            this again after forking, as the pool's threads don't survive
+            the fork.
+        '''
+        # shared between all clients so hot boot files are read from disk once
+        self.cache = BlockCache(self.cache_size, self.cache_chunk_size) if self.cache_size else None
+
+        # key is the client socket's file descriptor
+        self.ongoing = {}
+        self.poller = Poller()
+        self.poller.register(self.sock.fileno())
+        # runs the calls of backends that may block
+        self.pool = WorkerPool(self.threads, self.logger)
+        self.poller.register(self.pool.rfd)
+        self.stats = TFTPStats()
+        if self.stats_sock:
+            self.poller.register(self.stats_sock.fileno())
+            # (connection, rendered stats) written out on a thread of its
+            # own, so a slow reader doesn't hold up transfers
+            self.stats_replies = Queue.Queue()
+            writer = threading.Thread(target = self.write_stats)
+            writer.daemon = True
+            writer.start()
+        # heap of (deadline, sequence, client), at most one entry per client
+        self.timers = []
+        self.sequence = itertools.count()
+        # key is (filename, blksize)
+        self.multicast = {}
+        self.pacer = None
+        if self.rate_limit:
+            # workers share the limit, as the kernel shares the requests
+            rate = self.rate_limit / float(self.workers) if self.report_fd is not None else self.rate_limit
+            self.pacer = Pacer(rate, self.rate_burst)
+        # clients waiting to send a block, served round-robin, and the
+        # heap of (time, sequence, client) of those waiting for their own
+        # rate, by when they may send again
+        self.paced = deque()
+        self.waiting = []
+        self.turn = None
+
+    def arp_lookup(self, ip):
+        '''Returns the MAC address the kernel has for a neighbour's IP, or None.'''
+        if self.arp is None:
+            return None
+        self.arp.seek(0)
+        for line in self.arp.read().splitlines()[1:]:
+            fields = line.split()
+            # fields are IP, HW type, flags, MAC, mask and device; 0x0 is incomplete
+            if len(fields) >= 4 and fields[0] == ip and fields[2] != '0x0':
+                return fields[3]
+        return None
+
+    def register(self, client):
+        '''Starts watching the socket of a client.'''
+        fd = client.sock.fileno()
+        self.ongoing[fd] = client
+        self.poller.register(fd)
+
+    def unregister(self, client):
+        '''Stops watching the socket of a client, before it is closed.'''
+        fd = client.sock.fileno()
+        if self.ongoing.get(fd) is client:
+            self.poller.unregister(fd)
+            del self.ongoing[fd]
+
+    def join_multicast(self, client):
+        '''
+            Adds a client that asked for multicast to the session for its
+            file, starting a new session if needed. Returns False if the
+            client has to be served by unicast instead.
+        '''
+        if client.blocking_read:
+            # sessions read blocks synchronously from their source
+            del client.options['multicast']
+            return False
+        key = (client.filename, client.blksize)
+        session = self.multicast.get(key)
+        # multicast transfers are lock-step with the server's own timeout
+        client.options.pop('windowsize', None)
+        client.options.pop('timeout', None)
+        if session is None:
+            group = self.multicast_group()
+            if group is None:
+                client.logger.warning('No free multicast group, falling back to unicast')
+                del client.options['multicast']
+                return False
+            # the client becomes the session's source, so only close its socket
+            self.unregister(client)
+            client.sock.close()
+            session = MulticastSession(self, client, group)
+            self.multicast[key] = session
+            session.join(client)
+        else:
+            session.join(client)
+            client.complete()
+        return True
 
-        self.ongoing = []
+    def multicast_group(self):
+        '''Returns the first group address not used by a session, or None.'''
+        base = struct.unpack('!I', socket.inet_aton(self.multicast_address))[0]
+        used = set(session.group[0] for session in self.multicast.values())
+        for offset in xrange(self.multicast_groups):
+            address = socket.inet_ntoa(struct.pack('!I', base + offset))
+            if address not in used:
+                return (address, self.multicast_port)
+        return None
 
+    def end_multicast(self, session):
+        '''Forgets a completed multicast session.'''
+        key = (session.filename, session.source.blksize)
+        if self.multicast.get(key) is session:
+            del self.multicast[key]
+
+    def schedule(self, client):
+        '''
+            Makes sure a timer is pending for the client. Timers are not
+            moved when the client sends again; an early timer is re-armed
+            for the new deadline when it fires instead.
+        '''
+        if client.scheduled:
+            return
+        client.scheduled = True
+        heapq.heappush(self.timers, (client.deadline(), next(self.sequence), client))
+
+    def next_timeout(self):
+        '''Returns the number of seconds until the next timer is due.'''
+        now = time.time()
+        deadlines = [self.timers[0][0]] if self.timers else []
+        if self.report_fd is not None:
+            deadlines.append(self.next_report)
+        if self.paced or self.waiting:
+            deadlines.append(now + self.pace_delay(now))
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - now)
+
+    def pace(self, client):
+        '''
+            Determines if the client may send a block now, spending the
+            tokens if so; otherwise queues it to be called back with
+            send_window when it is its turn. Queued clients take turns
+            sending PACING_QUANTUM bytes each (deficit round-robin), so the
+            rate is shared fairly whatever their blksize.
+        '''
+        if self.pacer is None and client.pacer is None:
+            return True
+        if client.paced or (self.paced and self.turn is not client):
+            self.enqueue(client)
+            return False
+        now = time.time()
+        size = DATA_HEADER.size + client.blksize
+        if self.turn is client:
+            if client.deficit < size or not self.may_send(client, size, now):
+                # our turn is over, the rest waits for the next one
+                self.turn = None
+                self.enqueue(client)
+                return False
+            client.deficit -= size
+        elif not self.may_send(client, size, now):
+            self.enqueue(client)
+            return False
+        if self.pacer is not None:
+            self.pacer.take(size)
+        if client.pacer is not None:
+            client.pacer.take(size)
+        return True
+
+    def may_send(self, client, size, now):
+        '''Determines if both the server's and the client's rate allow size bytes.'''
+        if self.pacer is not None and not self.pacer.ready(size, now):
+            return False
+        return client.pacer is None or client.pacer.ready(size, now)
+
+    def enqueue(self, client, now = None):
+        '''Queues a client for its turn, or until its own rate lets it send.'''
+        if client.paced:
+            return
+        client.paced = True
+        now = time.time() if now is None else now
+        delay = client.pacer.delay(DATA_HEADER.size + client.blksize, now) if client.pacer is not None else 0
+        if delay:
+            heapq.heappush(self.waiting, (now + delay, next(self.sequence), client))
+        else:
+            self.paced.append(client)
+
+    def pace_delay(self, now):
+        '''Returns the number of seconds until a queued client may send.'''
+        delays = []
+        if self.paced:
+            # only the server's rate holds back the client next in turn
+            size = DATA_HEADER.size + self.paced[0].blksize
+            delays.append(self.pacer.delay(size, now) if self.pacer is not None else 0)
+        if self.waiting:
+            delays.append(max(0, self.waiting[0][0] - now))
+        return min(delays)
+
+    def run_pacing(self):
+        '''Gives a turn to every queued client that may send, round-robin.'''
+        now = time.time()
+        while self.waiting and self.waiting[0][0] <= now:
+            self.paced.append(heapq.heappop(self.waiting)[2])
+        for _ in xrange(len(self.paced)):
+            client = self.paced.popleft()
+            client.paced = False
+            if client.dead:
+                continue
+            size = DATA_HEADER.size + client.blksize
+            if self.pacer is not None and not self.pacer.ready(size, now):
+                self.paced.appendleft(client)
+                client.paced = True
+                break
+            if client.pacer is not None and not client.pacer.ready(size, now):
+                self.enqueue(client, now)
+                continue
+            client.deficit += self.PACING_QUANTUM
+            self.turn = client
+            client.send_window()
+            self.turn = None
+            if not client.paced:
+                # nothing left to send, credit isn't kept while idle
+                client.deficit = 0
+
+    def run_timers(self):
+        '''Retransmits for, or kills, every client whose ACK is overdue.'''
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, client = heapq.heappop(self.timers)
+            client.scheduled = False
+            if client.dead or client.paced:
+                # a queued client is timed again once it sends
+                continue
+            if client.no_ack():
+                # retry or kill the client if we have run out of retries
+                client.retransmit()
+            else:
+                self.schedule(client)
+
+    def send_stats(self):
+        '''Renders the stats for a connection on the stats socket, to be written by write_stats.'''
+        try:
+            conn, _ = self.stats_sock.accept()
+        except socket.error:
+            # spurious wakeup, the stats socket is non-blocking
+            return
+        self.stats_replies.put((conn, self.stats.render(self.stats_snapshot())))
+
+    def write_stats(self):
+        '''Writes rendered stats to their connections and closes them, on a thread.'''
+        while True:
+            conn, data = self.stats_replies.get()
+            try:
+                conn.settimeout(1)
+                conn.sendall(data)
+            except socket.error as e:
+                self.logger.debug('Could not send stats: {0}'.format(e))
+            finally:
+                conn.close()
+
+    def stats_snapshot(self):
+        '''Returns the stats of this process, or of all workers when supervising.'''
+        if self.workers <= 1 or self.report_fd is not None:
+            return self.stats.snapshot(self)
+        snapshots = [worker['snapshot'] for worker in self.running.values() if worker['snapshot']]
+        snapshot = TFTPStats.combine(snapshots + [self.retired] if self.retired else snapshots)
+        snapshot['workers'] = len(self.running)
+        snapshot['worker_restarts'] = self.restarts
+        return snapshot
+
+    def report(self):
+        '''Sends a snapshot of our stats to the supervisor, once a second.'''
+        self.next_report = time.time() + self.REPORT_INTERVAL
+        try:
+            os.write(self.report_fd, json.dumps(self.stats.snapshot(self)) + '\n')
+        except OSError as e:
+            if e.errno == errno.EPIPE:
+                self.logger.info('TFTP supervisor has gone away, exiting')
+                os._exit(0)
+            if e.errno != errno.EAGAIN:
+                raise
+            # the supervisor is behind, it gets the next snapshot instead
+
+    def spawn(self, index):
+        '''Forks worker process index, which serves requests until it dies.'''
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(rfd)
+                for fd in self.running:
+                    os.close(fd)
+                if self.stats_sock:
+                    self.stats_sock.close()
+                    self.stats_sock = None
+                fcntl.fcntl(wfd, fcntl.F_SETFL, fcntl.fcntl(wfd, fcntl.F_GETFL) | os.O_NONBLOCK)
+                self.report_fd = wfd
+                # our own socket, so the kernel hashes requests across the workers
+                self.sock = self.bind()
+                self.setup()
+                self.logger.info('TFTP worker {0} started'.format(index))
+                self.listen()
+            except:
+                self.logger.exception('TFTP worker {0} exception'.format(index))
+            finally:
+                os._exit(1)
+        os.close(wfd)
+        self.running[rfd] = {'pid': pid, 'index': index, 'buffer': '', 'snapshot': None, 'started': time.time()}
+        self.poller.register(rfd)
+
+    def reap(self, fd):
+        '''Waits for the worker whose pipe closed and starts a new one.'''
+        worker = self.running.pop(fd)
+        self.poller.unregister(fd)
+        os.close(fd)
+        if worker['snapshot']:
+            # the totals keep what it counted up to its last report
+            self.retired = TFTPStats.combine([snapshot for snapshot in (self.retired, TFTPStats.counters(worker['snapshot'])) if snapshot])
+        _, status = os.waitpid(worker['pid'], 0)
+        self.logger.error('TFTP worker {0} (pid {1}) died with status {2}, restarting it'.format(worker['index'], worker['pid'], status))
+        self.restarts += 1
+        # don't fork in a tight loop if the worker dies as soon as it starts
+        time.sleep(max(0, worker['started'] + 1 - time.time()))
+        self.spawn(worker['index'])
+
+    def supervise(self):
+        '''
+            Forks the worker processes, restarts those that die and serves
+            their combined stats. Transfer sockets are created by the worker
+            that received the request, so a transfer stays on one worker.
+        '''
+        # the workers bind their own sockets, ours would get a share of requests
+        self.poller.unregister(self.sock.fileno())
+        self.sock.close()
+        self.poller.unregister(self.pool.rfd)
+        # key is the read end of the worker's pipe
+        self.running = {}
+        self.restarts = 0
+        # the counters of the workers that died
+        self.retired = None
+        for index in xrange(self.workers):
+            self.spawn(index)
+        while True:
+            try:
+                for fd in self.poller.poll():
+                    if self.stats_sock and fd == self.stats_sock.fileno():
+                        self.send_stats()
+                        continue
+                    data = os.read(fd, 65536)
+                    if not data:
+                        self.reap(fd)
+                        continue
+                    worker = self.running[fd]
+                    lines = (worker['buffer'] + data).split('\n')
+                    worker['buffer'] = lines.pop()
+                    if lines:
+                        worker['snapshot'] = json.loads(lines[-1])
+            except:
+                self.logger.exception('supervisor loop exception')
 
     def listen(self):
         '''This method listens for incoming requests.'''
+        if self.workers > 1 and self.report_fd is None:
+            return self.supervise()
+        main = self.sock.fileno()
         while True:
             try:
-                # remove complete clients to select doesn't fail
-                map(self.ongoing.remove, [client for client in self.ongoing if client.dead])
-                rlist, _, _ = select.select([self.sock] + [client.sock for client in self.ongoing if not client.dead], [], [], 0)
-                for sock in rlist:
-                    if sock == self.sock:
+                for fd in self.poller.poll(self.next_timeout()):
+                    if fd == main:
                         # main socket, so new client
-                        client = self.client_cls(sock, self)
-                        self.ongoing.append(client)
+                        client = self.client_cls(self.sock, self)
                         client.handle()
-                    else:
+                    elif fd == self.pool.rfd:
+                        # blocking backend calls have completed
+                        self.pool.drain()
+                    elif self.stats_sock and fd == self.stats_sock.fileno():
+                        self.send_stats()
+                    elif fd in self.ongoing:
                         # client socket, so tell the client object it's ready
-                        sock.parent.ready()
+                        self.ongoing[fd].ready()
                 # if we haven't recieved an ACK in timeout time, retry
-                [client.send_block() for client in self.ongoing if client.no_ack()]
-                # if we have run out of retries, kill the client
-                [client.complete() for client in self.ongoing if client.no_retries()]
+                self.run_timers()
+                if self.paced or self.waiting:
+                    self.run_pacing()
+                if self.report_fd is not None and time.time() >= self.next_report:
+                    self.report()
             except:
                 self.logger.exception('listen loop exception')
 
@@ -330,7 +1761,7 @@ class TFTPD(BaseTFTPD):
         Implemention of TFTP class with local filesystem as backing storage.
     '''
     def __init__(self, **server_settings):
-        super(TFTPD, self).__init__(FileBackedClient, **server_settings)
+        super(TFTPD, self).__init__(TemplateBackedClient, **server_settings)
         self.netbook_directory = server_settings.get('netbook_directory', '.')
         self.logger.debug('Network Boot Directory: {0}'.format(self.netbook_directory))
 
@@ -0,0 +1,111 @@
+'''
+
+This file contains classes and functions that implement packet tracing
+shared by the PyPXE services
+
+'''
+
+import socket
+import struct
+import signal
+import itertools
+from time import time
+
+LINKTYPE_RAW = 101 # packets start with their IP header
+PCAP_HEADER = struct.Struct('<IHHiIII') # magic, version, zone, sigfigs, snaplen, linktype
+PCAP_RECORD = struct.Struct('<IIII') # seconds, microseconds, captured and original length
+IP_HEADER = struct.Struct('!BBHHHBBH4s4s')
+UDP_HEADER = struct.Struct('!HHHH')
+
+
+def inet_aton(ip):
+    '''Like socket.inet_aton, but also takes the addresses sockets are given, e.g. '<broadcast>'.'''
+    if ip == '<broadcast>':
+        return '\xff' * 4
+    try:
+        return socket.inet_aton(ip)
+    except socket.error:
+        return '\0' * 4
+
+
+def checksum(header):
+    '''The internet checksum of RFC 1071.'''
+    total = sum(struct.unpack('!{0}H'.format(len(header) / 2), header))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+class PacketTrace(object):
+    '''
+        Keeps the last capacity UDP packets the services sent and
+        received, raw and with their time, in a ring, to be written out
+        as a pcap file when something goes wrong. Recording a packet costs
+        a tuple, and a copy of packets crafted in a reused buffer, so
+        tracing can stay on in production; services that are not given a
+        trace don't record anything.
+    '''
+
+    def __init__(self, capacity = 65536):
+        self.capacity = capacity
+        self.packets = [None] * capacity
+        # next() on a count is atomic, so threads don't need a lock
+        self.sequence = itertools.count()
+
+    def record(self, source, destination, data):
+        '''Records a packet from source to destination, (ip, port) pairs.'''
+        if not isinstance(data, str):
+            data = memoryview(data).tobytes() # a view of a buffer that is reused
+        number = next(self.sequence)
+        self.packets[number % self.capacity] = (number, time(), source, destination, data)
+
+    def attach(self, sock, address = None):
+        '''
+            Records what a bound UDP socket sends and receives from now on,
+            by replacing its methods; address is where its packets come
+            from if not the address it is bound to.
+        '''
+        address = address if address else sock.getsockname()
+        record = self.record
+        sendto, recvfrom = sock.sendto, sock.recvfrom
+
+        def traced_sendto(data, *args):
+            sent = sendto(data, *args)
+            record(address, args[-1], data)
+            return sent
+
+        def traced_recvfrom(*args):
+            data, source = recvfrom(*args)
+            record(source, address, data)
+            return data, source
+
+        def traced_recv(*args):
+            return traced_recvfrom(*args)[0]
+
+        sock.sendto = traced_sendto
+        sock.recvfrom = traced_recvfrom
+        sock.recv = traced_recv
+
+    def dump(self, f):
+        '''Writes the packets in the ring to f as a pcap file, oldest first.'''
+        packets = sorted(packet for packet in list(self.packets) if packet)
+        f.write(PCAP_HEADER.pack(0xa1b2c3d4, 2, 4, 0, 0, 65535, LINKTYPE_RAW))
+        for number, timestamp, source, destination, data in packets:
+            length = IP_HEADER.size + UDP_HEADER.size + len(data)
+            header = IP_HEADER.pack(0x45, 0, length, number & 0xffff, 0, 64, socket.IPPROTO_UDP, 0,
+                                    inet_aton(source[0]), inet_aton(destination[0]))
+            header = header[:10] + struct.pack('!H', checksum(header)) + header[12:]
+            header += UDP_HEADER.pack(source[1], destination[1], length - IP_HEADER.size, 0) # no checksum
+            f.write(PCAP_RECORD.pack(int(timestamp), int(timestamp % 1 * 1000000), length, length))
+            f.write(header)
+            f.write(data)
+        return len(packets)
+
+    def dump_on(self, signum, f):
+        '''Rewrites f with the packets in the ring whenever the process gets signal signum.'''
+        def dump(signum, frame):
+            f.seek(0)
+            f.truncate()
+            self.dump(f)
+            f.flush()
+        signal.signal(signum, dump)